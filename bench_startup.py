@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Measure start-up cost of the ghost module.
+
+Each run uses a fresh interpreter so that nothing is already imported.
+
+How to use
+==========
+
+  $ python bench_startup.py -n 10 --import-budget 0.5 --startup-budget 1.5
+
+Exits with status 1 when a median exceeds its budget.
+"""
+import json
+import statistics
+import subprocess
+import sys
+
+from argparse import ArgumentParser
+
+
+SNIPPET = """
+import json, time
+t0 = time.perf_counter()
+import ghost
+t1 = time.perf_counter()
+g = ghost.Ghost()
+t2 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'startup': t2 - t1}))
+g.exit()
+"""
+
+
+def measure(runs):
+    """Returns timings of `runs` fresh imports and Ghost() start-ups."""
+    results = {'import': [], 'startup': []}
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', SNIPPET])
+        timings = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+        for key, value in timings.items():
+            results[key].append(value)
+    return results
+
+
+def main(args):
+    results = measure(args.runs)
+    budgets = {'import': args.import_budget, 'startup': args.startup_budget}
+    over_budget = False
+
+    for key, values in results.items():
+        median = statistics.median(values)
+        status = 'ok'
+        if budgets[key] is not None and median > budgets[key]:
+            status = 'OVER BUDGET ({:.3f}s)'.format(budgets[key])
+            over_budget = True
+        print("{:<8s} median {:.3f}s  min {:.3f}s  max {:.3f}s  {}".format(
+            key, median, min(values), max(values), status,
+        ))
+
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser()
+    ap.add_argument('-n', '--runs', type=int, default=5,
+                    help="number of fresh interpreters to measure")
+    ap.add_argument('--import-budget', type=float, default=None,
+                    help="maximum median seconds for 'import ghost'")
+    ap.add_argument('--startup-budget', type=float, default=None,
+                    help="maximum median seconds for 'Ghost()'")
+    sys.exit(main(ap.parse_args()))
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""HTTP capture service on top of ss_nowindow's WebKitShooter.
+
+Captures run on the Qt (main) thread, at most `--concurrency` at a time
+over one shared network manager; HTTP requests are served from threads.
+Identical requests in flight share one capture, and results are cached
+for `--cache-ttl` seconds.
+
+How to use
+==========
+
+  $ python capture_server.py --port 8080 --concurrency 4
+
+  POST /capture          JSON body:
+                           url       (required)
+                           width     viewport width, 1024
+                           height    viewport height, 768
+                           format    png or jpg, png
+                           cookies   {"name": "value", ...}
+                           wait      "load", "first_paint" or milliseconds
+                                     of network idle, "load"
+                           async     return a job id instead of the image
+  GET  /jobs/<id>        job status, as JSON
+  GET  /jobs/<id>/image  the captured image
+
+At most `--max-queue` captures wait to run (503 beyond that), and finished
+jobs are forgotten early once they hold more than `--max-memory` MB of
+images or number more than `--max-jobs`.
+"""
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from argparse import ArgumentParser
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PyQt5.QtWidgets import QApplication
+
+from ss_nowindow import WebKitShooter, make_cookies, shared_network_manager
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {'png': 'image/png', 'jpg': 'image/jpeg'}
+# seconds allowed on top of a `wait` for the network to go quiet
+IDLE_WAIT_GRACE = 5
+
+
+class QueueFull(Exception):
+    """Raised when a capture is submitted while the queue is full."""
+
+
+class Job(object):
+    """A capture request and its outcome."""
+
+    def __init__(self, key, options):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.options = options
+        self.status = 'queued'
+        self.image = None
+        self.error = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'error': self.error,
+            'options': self.options,
+        }
+
+
+class CaptureService(object):
+    """Runs capture jobs submitted from any thread on the Qt thread.
+
+    :param concurrency: Captures running at once.
+    :param cache_ttl: Seconds a result is served again without capturing.
+    :param job_timeout: Seconds before a capture is given up.
+    :param max_pending: Captures allowed to wait for a free slot.
+    :param max_jobs: Finished jobs kept for status and cache lookups.
+    :param max_image_bytes: Bytes of images kept by finished jobs.
+    """
+
+    def __init__(
+        self, concurrency=4, cache_ttl=300, job_timeout=60, max_pending=100,
+        max_jobs=1000, max_image_bytes=256 * 1024 * 1024,
+    ):
+        self.concurrency = concurrency
+        self.cache_ttl = cache_ttl
+        self.job_timeout = job_timeout
+        self.max_pending = max_pending
+        self.max_jobs = max_jobs
+        self.max_image_bytes = max_image_bytes
+        self._image_bytes = 0
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._jobs = {}
+        # key -> job, for coalescing identical requests
+        self._inflight = {}
+        # key -> (expires at, job)
+        self._cache = {}
+        # (expires at, job) of finished jobs, oldest first
+        self._retired = deque()
+        # job id -> (shooter, started at)
+        self._active = {}
+        self._workdir = tempfile.mkdtemp(prefix='capture-server-')
+        self._manager = None
+
+    def normalize(self, request):
+        """Return the options of a capture request, with defaults."""
+        if not request.get('url'):
+            raise ValueError('url is required')
+        image_format = request.get('format', 'png').lower()
+        image_format = 'jpg' if image_format == 'jpeg' else image_format
+        if image_format not in CONTENT_TYPES:
+            raise ValueError('unsupported format: %s' % image_format)
+        wait = request.get('wait', 'load')
+        if wait not in ('load', 'first_paint') and (
+            isinstance(wait, bool) or not isinstance(wait, int) or wait < 0
+        ):
+            raise ValueError('wait must be "load", "first_paint" or milliseconds')
+        if isinstance(wait, int) and wait / 1000.0 >= self.job_timeout:
+            raise ValueError(
+                'wait must be shorter than the job timeout (%ss)' % self.job_timeout)
+        width = int(request.get('width', 1024))
+        height = int(request.get('height', 768))
+        if width <= 0 or height <= 0:
+            raise ValueError('width and height must be positive')
+        return {
+            'url': request['url'],
+            'width': width,
+            'height': height,
+            'format': image_format,
+            'cookies': dict(request.get('cookies') or {}),
+            'wait': wait,
+        }
+
+    def submit(self, options):
+        """Return the job serving `options`: a cached or in-flight one when
+        possible, otherwise a new queued job.
+
+        Raises QueueFull when `max_pending` jobs are already waiting.
+        """
+        key = json.dumps(options, sort_keys=True)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > time.time():
+                logger.debug("Cache hit: %s", options['url'])
+                return cached[1]
+            job = self._inflight.get(key)
+            if job is not None:
+                logger.debug("Coalesced: %s", options['url'])
+                return job
+            if len(self._pending) >= self.max_pending:
+                raise QueueFull('%d captures already queued' % len(self._pending))
+            job = Job(key, options)
+            self._jobs[job.id] = job
+            self._inflight[key] = job
+            self._pending.append(job)
+            return job
+
+    def get(self, job_id):
+        """Return a job by id, or None."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _start(self, job):
+        options = job.options
+        cookies = make_cookies(options['cookies'])
+        kwargs = dict(
+            width=options['width'],
+            height=options['height'],
+            prefix=os.path.join(self._workdir, job.id),
+            image_format=options['format'],
+            above_the_fold=options['wait'] == 'first_paint',
+        )
+        if isinstance(options['wait'], int):
+            kwargs['idle_ms'] = options['wait']
+            # the shooter captures anyway after `wait_time` seconds
+            kwargs['wait_time'] = min(
+                options['wait'] / 1000.0 + IDLE_WAIT_GRACE, self.job_timeout)
+        if cookies:
+            # a private jar, cookies must not leak to other requests
+            kwargs['cookies'] = cookies
+        else:
+            kwargs['network_access_manager'] = self._manager
+
+        shooter = WebKitShooter(options['url'], **kwargs)
+        shooter.run()
+        job.status = 'running'
+        self._active[job.id] = (shooter, time.time())
+
+    def _finish(self, job, shooter):
+        if shooter.finished:
+            path = shooter.files[0]
+            with open(path, 'rb') as f:
+                job.image = f.read()
+            job.status = 'done'
+        else:
+            job.error = shooter.error or 'timeout'
+            job.status = 'failed'
+        for path in shooter.files:
+            os.remove(path)
+        shooter.release()
+
+        expires_at = time.time() + self.cache_ttl
+        with self._lock:
+            del self._inflight[job.key]
+            if job.status == 'done':
+                self._cache[job.key] = (expires_at, job)
+                self._image_bytes += len(job.image)
+            self._retired.append((expires_at, job))
+        logger.info("Job %s %s: %s", job.id, job.status, job.options['url'])
+        job.done.set()
+
+    def _expire(self):
+        """Forget finished jobs past their TTL, and the oldest ones while
+        over `max_jobs` or `max_image_bytes`."""
+        now = time.time()
+        with self._lock:
+            while self._retired and (
+                self._retired[0][0] <= now or
+                len(self._retired) > self.max_jobs or
+                self._image_bytes > self.max_image_bytes
+            ):
+                expires_at, job = self._retired.popleft()
+                del self._jobs[job.id]
+                if self._cache.get(job.key, (None, None))[1] is job:
+                    del self._cache[job.key]
+                if job.image is not None:
+                    self._image_bytes -= len(job.image)
+                    job.image = None
+
+    def run(self):
+        """Process jobs forever; must be called from the main thread."""
+        qapp = QApplication.instance() or QApplication(sys.argv)
+        self._manager = shared_network_manager()
+        last_expire = time.time()
+        try:
+            while True:
+                while len(self._active) < self.concurrency:
+                    with self._lock:
+                        job = self._pending.popleft() if self._pending else None
+                    if job is None:
+                        break
+                    try:
+                        self._start(job)
+                    except Exception as e:
+                        logger.exception("Unable to start job %s", job.id)
+                        job.error, job.status = repr(e), 'failed'
+                        with self._lock:
+                            del self._inflight[job.key]
+                            self._retired.append((time.time() + self.cache_ttl, job))
+                        job.done.set()
+
+                for job_id, (shooter, started_at) in list(self._active.items()):
+                    if (
+                        shooter.finished or shooter.error is not None or
+                        time.time() - started_at > self.job_timeout
+                    ):
+                        del self._active[job_id]
+                        self._finish(self._jobs[job_id], shooter)
+
+                if time.time() - last_expire > 1 or (
+                    self._image_bytes > self.max_image_bytes
+                ):
+                    self._expire()
+                    last_expire = time.time()
+                qapp.processEvents()
+                time.sleep(0.01)
+        finally:
+            shutil.rmtree(self._workdir, ignore_errors=True)
+
+
+def make_handler(service, wait_timeout):
+    """Return the request handler class serving `service`."""
+
+    class CaptureHandler(BaseHTTPRequestHandler):
+        def _send(self, status, body, content_type='application/json'):
+            if content_type == 'application/json':
+                body = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_image(self, job):
+            image = job.image
+            if job.status == 'done' and image is None:
+                # forgotten to stay under --max-memory
+                self._send(410, {'error': 'image expired'})
+            elif job.status == 'done':
+                self._send(200, image, CONTENT_TYPES[job.options['format']])
+            elif job.status == 'failed':
+                self._send(502, job.to_dict())
+            else:
+                self._send(202, job.to_dict())
+
+        def do_POST(self):
+            if self.path != '/capture':
+                return self._send(404, {'error': 'not found'})
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length).decode('utf-8'))
+                options = service.normalize(request)
+            except (ValueError, TypeError, AttributeError) as e:
+                return self._send(400, {'error': str(e)})
+
+            try:
+                job = service.submit(options)
+            except QueueFull as e:
+                return self._send(503, {'error': str(e)})
+            if request.get('async'):
+                return self._send(202, job.to_dict())
+            job.done.wait(wait_timeout)
+            self._send_image(job)
+
+        def do_GET(self):
+            parts = self.path.strip('/').split('/')
+            if len(parts) not in (2, 3) or parts[0] != 'jobs':
+                return self._send(404, {'error': 'not found'})
+            job = service.get(parts[1])
+            if job is None:
+                return self._send(404, {'error': 'unknown job'})
+            if len(parts) == 2:
+                return self._send(200, job.to_dict())
+            if parts[2] != 'image':
+                return self._send(404, {'error': 'not found'})
+            self._send_image(job)
+
+        def log_message(self, format, *args):
+            logger.debug("%s " + format, self.address_string(), *args)
+
+    return CaptureHandler
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO)
+    service = CaptureService(
+        concurrency=args.concurrency,
+        cache_ttl=args.cache_ttl,
+        job_timeout=args.job_timeout,
+        max_pending=args.max_queue,
+        max_jobs=args.max_jobs,
+        max_image_bytes=args.max_memory * 1024 * 1024,
+    )
+    server = ThreadingHTTPServer(
+        (args.host, args.port),
+        make_handler(service, args.job_timeout * 2),
+    )
+    thread = threading.Thread(target=server.serve_forever, name='capture-http')
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving captures on http://%s:%d/", args.host, args.port)
+    try:
+        service.run()
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser()
+    ap.add_argument('--host', default='127.0.0.1',
+                    help="address to listen on")
+    ap.add_argument('--port', type=int, default=8080,
+                    help="port to listen on")
+    ap.add_argument('--concurrency', type=int, default=4,
+                    help="captures running at once")
+    ap.add_argument('--cache-ttl', type=float, default=300,
+                    help="seconds a capture is served from cache")
+    ap.add_argument('--job-timeout', type=float, default=60,
+                    help="seconds before a capture is given up")
+    ap.add_argument('--max-queue', type=int, default=100,
+                    help="captures waiting to run before answering 503")
+    ap.add_argument('--max-jobs', type=int, default=1000,
+                    help="finished jobs kept for status and cache")
+    ap.add_argument('--max-memory', type=int, default=256,
+                    help="MB of images kept by finished jobs")
+    sys.exit(main(ap.parse_args()))
@@ -1,15 +1,31 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import base64
 import codecs
+import copy
+import gzip
+import hashlib
+import html
+import itertools
+import json
 import logging
 import os
+import queue
 import re
+import shutil
+import signal
+import sqlite3
+import subprocess
 import sys
+import threading
 import time
 import uuid
 
+from collections import OrderedDict
 from http.cookiejar import Cookie, LWPCookieJar
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 from functools import wraps
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 from PyQt5.QtCore import (
     QByteArray,
@@ -34,6 +50,7 @@ from PyQt5.QtWidgets import (
     QApplication,
 )
 from PyQt5.QtNetwork import (
+    QHostInfo,
     QNetworkAccessManager,
     QNetworkCookie,
     QNetworkCookieJar,
@@ -42,10 +59,10 @@ from PyQt5.QtNetwork import (
 )
 from PyQt5.QtWebKit import QWebSettings
 from PyQt5.QtWebKitWidgets import (
+    QWebFrame,
     QWebPage,
     QWebView,
 )
-from xvfbwrapper import Xvfb
 
 DEFAULT_USERAGENT = (
     'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_5)'
@@ -53,6 +70,37 @@ DEFAULT_USERAGENT = (
     ' CDP/47.0.2526.73 Safari/537.36'
 )
 
+# Subresource requests blocked by the fast capture profile: media, web
+# fonts and common tracking beacons (see `is_main_document_request()`).
+# Also used by ss_nowindow.
+FAST_CAPTURE_EXCLUDE = (
+    r'\.(mp4|webm|ogv|ogg|mp3|wav|m4a|flac|m3u8|mpd|woff2?|ttf|otf|eot)([?#]|$)'
+    r'|/(beacon|collect|pixel|track)([/?#]|$)'
+)
+NO_ANIMATION_CSS = (
+    '*, *::before, *::after {'
+    ' animation: none !important; transition: none !important; }'
+)
+# The document's <!DOCTYPE>, as written in it, or '' when it has none.
+DOCTYPE_JS = """(function (d) {
+    if (!d) return '';
+    return '<!DOCTYPE ' + d.name +
+        (d.publicId ? ' PUBLIC "' + d.publicId + '"' : '') +
+        (d.systemId ? (d.publicId ? '' : ' SYSTEM') +
+            ' "' + d.systemId + '"' : '') + '>';
+})(document.doctype)"""
+# [kind, data] for each child node of the element, kind being 'element'
+# (data empty), 'text' or 'comment'.
+CHILD_NODES_JS = """(function (e) {
+    var nodes = [];
+    for (var n = e.firstChild; n; n = n.nextSibling) {
+        if (n.nodeType === 1) nodes.push(['element', '']);
+        else if (n.nodeType === 3) nodes.push(['text', n.data]);
+        else if (n.nodeType === 8) nodes.push(['comment', n.data]);
+    }
+    return nodes;
+})(this)"""
+
 logger = logging.getLogger('ghost')
 logger.addHandler(logging.NullHandler())
 
@@ -81,6 +129,125 @@ class QTMessageProxy(object):
         self.logger.log(levels[msg_type], msg)
 
 
+class JSONLinesHandler(logging.Handler):
+    """Logging handler writing records as JSON lines from a background
+    thread, in batches.
+
+    emit() only renders the message and queues the record, so logging
+    from Qt callbacks does not wait on I/O. Fields passed through `extra`
+    (and the session id of `Session.logger`) become JSON keys.
+
+    :param stream: A text file object, stderr by default.
+    :param path: A file to append to instead of a stream.
+    :param batch_size: Maximum number of records per write.
+    :param flush_interval: Seconds a record may wait for a batch to fill.
+    """
+    _reserved = frozenset(vars(logging.LogRecord(
+        '', logging.INFO, '', 0, '', (), None)).keys()) | {'message'}
+
+    def __init__(self, stream=None, path=None, batch_size=100, flush_interval=0.5):
+        super(JSONLinesHandler, self).__init__()
+        if path is not None:
+            stream = open(path, 'a', encoding='utf-8')
+            self._owns_stream = True
+        else:
+            self._owns_stream = False
+        self.stream = sys.stderr if stream is None else stream
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='ghost-log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def to_dict(self, record):
+        """Returns the JSON document of a log record.
+
+        :param record: The LogRecord.
+        """
+        event = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.message,
+        }
+        for key, value in vars(record).items():
+            if key not in self._reserved:
+                event[key] = value
+        if record.exc_info:
+            event['exc_info'] = logging.Formatter().formatException(record.exc_info)
+        return event
+
+    def emit(self, record):
+        try:
+            # a copy: other handlers format the same record, and the
+            # arguments may not survive until the writer thread
+            record = copy.copy(record)
+            record.message = record.getMessage()
+            record.args = None
+            self._queue.put(record)
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(
+                        timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+            lines = []
+            for record in batch:
+                if record is None:
+                    continue
+                try:
+                    lines.append(json.dumps(self.to_dict(record), default=str))
+                except Exception:
+                    self.handleError(record)
+            if lines:
+                self.stream.write('\n'.join(lines) + '\n')
+                self.stream.flush()
+
+    def close(self):
+        """Writes pending records and stops the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._owns_stream:
+            self.stream.close()
+        super(JSONLinesHandler, self).close()
+
+
+def enable_json_logging(level=logging.INFO, target=None, **kwargs):
+    """Sends ghost's logs as JSON lines through a `JSONLinesHandler`.
+
+    :param level: Records below this level are discarded before any
+        formatting happens.
+    :param target: The logger to attach to, ghost's by default.
+    :param kwargs: `JSONLinesHandler` arguments.
+    :return: The handler, close() it to flush pending records.
+    """
+    if target is None:
+        target = logger
+    handler = JSONLinesHandler(**kwargs)
+    target.addHandler(handler)
+    target.setLevel(level)
+    return handler
+
+
+class SessionLoggerAdapter(logging.LoggerAdapter):
+    """Tags records with the session id, keeping fields given as `extra`."""
+    def process(self, msg, kwargs):
+        kwargs['extra'] = dict(self.extra, **kwargs.get('extra', {}))
+        return msg, kwargs
+
+
 class GhostWebPage(QWebPage):
     """Overrides QtWebKitwidgets.QWebPage in order to intercept some graphical
     behaviours like alert(), confirm0().
@@ -192,8 +359,9 @@ class HttpResource(object):
         self.content = bytes(content.data())
         self.http_status = reply.attribute(
             QNetworkRequest.HttpStatusCodeAttribute)
-        self.session.logger.info(
+        self.session.logger.debug(
             "Resource loaded: %s %s", self.url, self.http_status,
+            extra={'event': 'resource', 'url': self.url, 'status': self.http_status},
         )
         self.headers = {}
         for header in reply.rawHeaderList():
@@ -218,32 +386,1163 @@ def replyReadyRead(reply):
     reply.data += reply.peek(reply.bytesAvailable())
 
 
+class ResourceBudget(object):
+    """Limits what a session may spend on a single page.
+
+    Once a limit is crossed, further requests are blocked, the page load is
+    stopped and `exceeded` records which limit was hit, so the caller can
+    go on capturing what has been loaded so far.
+
+    :param max_requests: Maximum number of requests.
+    :param max_bytes: Maximum number of downloaded bytes.
+    :param max_time: Maximum seconds since the page was opened.
+    :param max_dom_nodes: Maximum number of elements in the document.
+    """
+    def __init__(
+        self,
+        max_requests=None,
+        max_bytes=None,
+        max_time=None,
+        max_dom_nodes=None,
+    ):
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.max_time = max_time
+        self.max_dom_nodes = max_dom_nodes
+        self.reset()
+
+    def reset(self):
+        """Starts accounting for a new page."""
+        self.requests = 0
+        self.bytes = 0
+        self.started_at = time.time()
+        self.exceeded = None
+        self.stopped = False
+
+    def exceed(self, limit):
+        """Records the first limit crossed.
+
+        :param limit: The name of the limit.
+        """
+        if self.exceeded is None:
+            self.exceeded = limit
+
+
+def page_for_request(request):
+    """Returns the QWebPage a request has been made for, if any.
+
+    QtWebKit tags every request with the QWebFrame it originates from,
+    which lets a manager shared by several pages tell them apart.
+    """
+    frame = request.originatingObject()
+    if isinstance(frame, QWebFrame):
+        return frame.page()
+    return None
+
+
+class WarmedHosts(object):
+    """Hosts warmed up recently, so that they are not warmed up again
+    within `ttl` seconds. At most `max_hosts` are remembered, the least
+    recently warmed ones are forgotten first. Also used by ss_nowindow.
+
+    :param ttl: Seconds a warmed host is considered warm.
+    :param max_hosts: Number of hosts remembered.
+    """
+    def __init__(self, ttl=60, max_hosts=256):
+        self.ttl = ttl
+        self.max_hosts = max_hosts
+        self._hosts = OrderedDict()
+
+    def __len__(self):
+        return len(self._hosts)
+
+    def claim(self, key, ttl=None):
+        """Records `key` as warmed now, unless it already is warm.
+
+        :param key: A hashable identifying a host (and how it is warmed).
+        :param ttl: An optional ttl overriding the default one.
+        :return: True if the host has to be warmed up.
+        """
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        warmed_at = self._hosts.get(key)
+        if warmed_at is not None and now - warmed_at < ttl:
+            return False
+        self._hosts[key] = now
+        self._hosts.move_to_end(key)
+        while len(self._hosts) > self.max_hosts:
+            self._hosts.popitem(last=False)
+        return True
+
+
+_page_keys = itertools.count(1)
+
+
+def page_key(page):
+    """Returns a key identifying a QWebPage for its whole life.
+
+    Unlike id(), it is never given to another page once this one is gone.
+    It is kept as a Qt property, which survives the Python wrapper.
+
+    :param page: The QWebPage.
+    """
+    key = page.property('ghost_page_key')
+    if key is None:
+        key = next(_page_keys)
+        page.setProperty('ghost_page_key', key)
+    return key
+
+
+def is_main_document_request(request):
+    """Tells if a request loads the document of a page's main frame, as
+    opposed to one of its subresources.
+
+    WebKit asks for HTML first only when loading a document.
+    """
+    frame = request.originatingObject()
+    return (
+        isinstance(frame, QWebFrame) and
+        frame.parentFrame() is None and
+        bytes(request.rawHeader(b'Accept')).startswith(b'text/html')
+    )
+
+
 class NetworkAccessManager(QNetworkAccessManager):
     """Subclass QNetworkAccessManager to always cache the reply content
+    and keep track of in-flight requests, globally and per page.
+
+    A single instance can serve many sessions (see `Session`'s
+    `network_access_manager`), sharing its connection pool and cache.
 
     :param exclude_regex: A regex use to determine which url exclude
         when sending a request
+    :param block_subframes: Block every request made by an iframe.
+    :param metrics: The `Metrics` registry to update, the module's
+        `registry` by default.
+    :param fast_capture: Block the subresources matched by
+        `FAST_CAPTURE_EXCLUDE`.
     """
-    def __init__(self, exclude_regex=None, *args, **kwargs):
+    def __init__(
+        self,
+        exclude_regex=None,
+        block_subframes=False,
+        metrics=None,
+        fast_capture=False,
+        *args,
+        **kwargs
+    ):
         self._regex = re.compile(exclude_regex) if exclude_regex else None
+        self._fast_capture_regex = (
+            re.compile(FAST_CAPTURE_EXCLUDE) if fast_capture else None)
+        self.block_subframes = block_subframes
+        self.metrics = registry if metrics is None else metrics
         super(NetworkAccessManager, self).__init__(*args, **kwargs)
+        self.inflight = 0
+        self.blocked = 0
+        self.last_activity = time.time()
+        self.budget = None
+        self._warmed = WarmedHosts()
+        # page_key() -> [in-flight requests, last activity]
+        self._pages = {}
+        self.finished.connect(self._request_finished)
+
+    def _track(self, page_key, delta):
+        now = time.time()
+        self.inflight += delta
+        self.last_activity = now
+        if page_key is not None:
+            if delta < 0 and page_key not in self._pages:
+                # the page was forgotten while its requests were running
+                return
+            activity = self._pages.setdefault(page_key, [0, now])
+            activity[0] += delta
+            activity[1] = now
+
+    def _request_finished(self, reply):
+        self._track(reply.property('page_key'), -1)
+        self.metrics.inc('ghost_bytes_fetched_total', len(getattr(reply, 'data', '')))
+
+    def forget_page(self, page):
+        """Drops the activity kept for a page that is going away.
+
+        :param page: The QWebPage.
+        """
+        self._pages.pop(page_key(page), None)
+
+    def _count_bytes(self, reply, received, budget):
+        budget.bytes += received - getattr(reply, 'budget_bytes', 0)
+        reply.budget_bytes = received
+        if budget.max_bytes is not None and budget.bytes > budget.max_bytes:
+            budget.exceed('max_bytes')
+            reply.abort()
+
+    def is_idle(self, idle_ms=500, max_inflight=0, page=None):
+        """Checks if the network has been quiet for long enough.
+
+        :param idle_ms: Milliseconds without any request starting or ending.
+        :param max_inflight: Number of requests allowed to be still running
+            (e.g. long-polling connections).
+        :param page: Only consider requests of this QWebPage.
+        """
+        if page is None:
+            inflight, last_activity = self.inflight, self.last_activity
+        else:
+            inflight, last_activity = self._pages.get(page_key(page), (0, 0))
+        return (
+            inflight <= max_inflight and
+            (time.time() - last_activity) * 1000 >= idle_ms
+        )
+
+    def warm_up(self, urls, connect=True, ttl=None):
+        """Resolves and pre-connects the hosts of given urls, so that later
+        requests skip DNS lookups and TCP/TLS handshakes.
+
+        Resolved names go to Qt's process-wide host cache (kept 60 seconds
+        by Qt) and connections to this manager's keep-alive pool. Hosts
+        warmed less than `ttl` seconds ago are skipped, see `WarmedHosts`.
+
+        :param urls: Iterable of url strings, or hosts for plain http.
+        :param connect: Open connections too, not only resolve names.
+        :param ttl: Seconds a warmed host is considered warm, 60 by default.
+        """
+        for address in urls:
+            url = QUrl(address if '://' in address else 'http://' + address)
+            secure = url.scheme() == 'https'
+            key = (url.host(), url.port(443 if secure else 80), secure, connect)
+            if not self._warmed.claim(key, ttl):
+                continue
+
+            if not connect:
+                QHostInfo.lookupHost(url.host(), lambda info: None)
+            elif secure:
+                self.connectToHostEncrypted(url.host(), key[1])
+            else:
+                self.connectToHost(url.host(), key[1])
+
+    def _budget_for(self, page):
+        if self.budget is not None:
+            return self.budget
+        session = getattr(page, 'session', None)
+        return getattr(session, 'budget', None)
+
+    def _within_budget(self, budget):
+        if budget is None:
+            return True
+        if (
+            budget.max_requests is not None and
+            budget.requests >= budget.max_requests
+        ):
+            budget.exceed('max_requests')
+        if budget.exceeded is not None:
+            return False
+        budget.requests += 1
+        return True
+
+    def _is_blocked(self, request, budget):
+        url = str(request.url().toString())
+        if self._regex and self._regex.findall(url):
+            return True
+        if (
+            self._fast_capture_regex and
+            self._fast_capture_regex.search(url) and
+            not is_main_document_request(request)
+        ):
+            return True
+        if self.block_subframes:
+            frame = request.originatingObject()
+            if isinstance(frame, QWebFrame) and frame.parentFrame() is not None:
+                return True
+        return not self._within_budget(budget)
 
     def createRequest(self, operation, request, data):
-        if self._regex and self._regex.findall(str(request.url().toString())):
-            return QNetworkAccessManager.createRequest(
+        page = page_for_request(request)
+        key = page_key(page) if page is not None else None
+        budget = self._budget_for(page)
+        self._track(key, 1)
+
+        if self._is_blocked(request, budget):
+            self.blocked += 1
+            self.metrics.inc('ghost_requests_blocked_total')
+            reply = QNetworkAccessManager.createRequest(
                 self, QNetworkAccessManager.GetOperation,
-                QNetworkAccessManager(QUrl()))
+                QNetworkRequest(QUrl()))
+            reply.setProperty('page_key', key)
+            return reply
         reply = QNetworkAccessManager.createRequest(
             self,
             operation,
             request,
             data,
         )
+        reply.setProperty('page_key', key)
         reply.readyRead.connect(lambda reply=reply: replyReadyRead(reply))
+        if budget is not None:
+            reply.downloadProgress.connect(
+                lambda received, total, reply=reply:
+                    self._count_bytes(reply, received, budget))
         time.sleep(0.001)
         return reply
 
 
+class SQLiteCookieJar(QNetworkCookieJar):
+    """QNetworkCookieJar backed by a SQLite database indexed by domain.
+
+    Cookies are read from the database per request domain and written back
+    as soon as they are set, so several sessions (or processes) can point
+    at the same file without re-parsing a whole cookie file on start.
+
+    :param path: The database file location (':memory:' for a private store).
+    :param timeout: Seconds to wait for another writer to release the lock.
+    """
+    _schema = """
+        CREATE TABLE IF NOT EXISTS cookies (
+            domain TEXT NOT NULL,
+            path TEXT NOT NULL,
+            name BLOB NOT NULL,
+            raw BLOB NOT NULL,
+            expires INTEGER,
+            PRIMARY KEY (domain, path, name)
+        );
+        CREATE INDEX IF NOT EXISTS cookies_domain ON cookies (domain);
+    """
+
+    def __init__(self, path, timeout=5.0, *args, **kwargs):
+        super(SQLiteCookieJar, self).__init__(*args, **kwargs)
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=timeout)
+        if path != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+        with self._db:
+            self._db.executescript(self._schema)
+            self._db.execute(
+                'DELETE FROM cookies WHERE expires IS NOT NULL AND expires < ?',
+                (int(time.time()),),
+            )
+
+    @staticmethod
+    def _domains_for_host(host):
+        """Returns every cookie domain that may match given host."""
+        host = host.lower()
+        domains = [host, '.' + host]
+        labels = host.split('.')
+        for i in range(1, len(labels) - 1):
+            domains.append('.' + '.'.join(labels[i:]))
+        return domains
+
+    @staticmethod
+    def _row(cookie):
+        if cookie.isSessionCookie():
+            expires = None
+        else:
+            expires = int(cookie.expirationDate().toTime_t())
+        return (
+            str(cookie.domain()).lower(),
+            str(cookie.path()),
+            bytes(cookie.name()),
+            bytes(cookie.toRawForm(QNetworkCookie.Full)),
+            expires,
+        )
+
+    def _store(self, cookies):
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO cookies VALUES (?, ?, ?, ?, ?)',
+                [self._row(c) for c in cookies],
+            )
+
+    def _load(self, url):
+        """Replaces the in-memory cookies of the url's domains with the
+        stored ones, so that rows written or deleted by other sessions and
+        processes are seen.
+
+        Qt's insertCookie() would go through our deleteCookie() and drop
+        the very rows being read, so the whole list is swapped instead.
+        """
+        domains = self._domains_for_host(url.host())
+        rows = self._db.execute(
+            'SELECT raw FROM cookies WHERE domain IN (%s)'
+            ' AND (expires IS NULL OR expires >= ?)'
+            % ', '.join('?' * len(domains)),
+            domains + [int(time.time())],
+        ).fetchall()
+        cookies = [
+            cookie
+            for cookie in super(SQLiteCookieJar, self).allCookies()
+            if str(cookie.domain()).lower() not in domains
+        ]
+        for raw, in rows:
+            cookies.extend(QNetworkCookie.parseCookies(QByteArray(raw)))
+        super(SQLiteCookieJar, self).setAllCookies(cookies)
+
+    def cookiesForUrl(self, url):
+        self._load(url)
+        return super(SQLiteCookieJar, self).cookiesForUrl(url)
+
+    def insertCookie(self, cookie):
+        # setCookiesFromUrl() goes through here too. Expired cookies are
+        # stored as well: they replace the live row and mark it deleted.
+        inserted = super(SQLiteCookieJar, self).insertCookie(cookie)
+        self._store([cookie])
+        return inserted
+
+    def deleteCookie(self, cookie):
+        with self._db:
+            self._db.execute(
+                'DELETE FROM cookies WHERE domain = ? AND path = ? AND name = ?',
+                self._row(cookie)[:3],
+            )
+        return super(SQLiteCookieJar, self).deleteCookie(cookie)
+
+    def allCookies(self):
+        rows = self._db.execute(
+            'SELECT raw FROM cookies WHERE expires IS NULL OR expires >= ?',
+            (int(time.time()),),
+        ).fetchall()
+        cookies = []
+        for raw, in rows:
+            cookies.extend(QNetworkCookie.parseCookies(QByteArray(raw)))
+        return cookies
+
+    def setAllCookies(self, cookie_list):
+        with self._db:
+            self._db.execute('DELETE FROM cookies')
+        super(SQLiteCookieJar, self).setAllCookies(cookie_list)
+        self._store(cookie_list)
+
+    def close(self):
+        """Closes the underlying database connection."""
+        self._db.close()
+
+
+class SharedCookieJar(QNetworkCookieJar):
+    """Thread-safe QNetworkCookieJar meant to be shared by many sessions.
+
+    Cookies are partitioned by base domain (the last two host labels), each
+    partition being a private QNetworkCookieJar guarded by its own lock, so
+    pages on different sites never wait on each other.
+
+    Pass the same instance as `cookie_jar` to every `Session` that should
+    share a login.
+    """
+    def __init__(self, *args, **kwargs):
+        super(SharedCookieJar, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._partitions = {}
+
+    @staticmethod
+    def _partition_key(domain):
+        return '.'.join(str(domain).lstrip('.').lower().split('.')[-2:])
+
+    def _partition(self, domain):
+        key = self._partition_key(domain)
+        with self._lock:
+            if key not in self._partitions:
+                self._partitions[key] = (threading.Lock(), QNetworkCookieJar())
+            return self._partitions[key]
+
+    def cookiesForUrl(self, url):
+        lock, jar = self._partition(url.host())
+        with lock:
+            return jar.cookiesForUrl(url)
+
+    def setCookiesFromUrl(self, cookie_list, url):
+        # A response may only set cookies for its host or a parent domain,
+        # which all live in the host's partition.
+        lock, jar = self._partition(url.host())
+        with lock:
+            return jar.setCookiesFromUrl(cookie_list, url)
+
+    def insertCookie(self, cookie):
+        lock, jar = self._partition(cookie.domain())
+        with lock:
+            return jar.insertCookie(cookie)
+
+    def updateCookie(self, cookie):
+        lock, jar = self._partition(cookie.domain())
+        with lock:
+            return jar.updateCookie(cookie)
+
+    def deleteCookie(self, cookie):
+        lock, jar = self._partition(cookie.domain())
+        with lock:
+            return jar.deleteCookie(cookie)
+
+    def allCookies(self):
+        with self._lock:
+            partitions = list(self._partitions.values())
+        cookies = []
+        for lock, jar in partitions:
+            with lock:
+                cookies.extend(jar.allCookies())
+        return cookies
+
+    def setAllCookies(self, cookie_list):
+        with self._lock:
+            self._partitions = {}
+        for cookie in cookie_list:
+            self.insertCookie(cookie)
+
+
+class XvfbBroker(object):
+    """Leases displays from a fixed pool of Xvfb servers.
+
+    The pool state (server pids, the pids holding leases) lives in a JSON
+    file guarded by an exclusive flock, so every process using the same
+    `state_dir` shares the same servers. Leases of processes that died
+    without releasing them are dropped. A server is started on first
+    lease, health checked on every lease and restarted once it has served
+    `max_uses` leases and is no longer in use.
+
+    :param size: Number of Xvfb servers in the pool.
+    :param first_display: Display number of the first server.
+    :param display_size: A tuple with the screen width and height.
+    :param max_uses: Leases served before a server is recycled (None to
+        never recycle).
+    :param state_dir: Directory holding the shared pool state.
+    :param start_timeout: Seconds to wait for a new server to accept
+        connections, and for a stopped one to exit.
+    """
+    def __init__(
+        self,
+        size=4,
+        first_display=90,
+        display_size=(1600, 900),
+        max_uses=None,
+        state_dir='/tmp/ghost-xvfb',
+        start_timeout=10,
+    ):
+        self.displays = list(range(first_display, first_display + size))
+        self.display_size = display_size
+        self.max_uses = max_uses
+        self.state_dir = state_dir
+        self.start_timeout = start_timeout
+        # display -> Popen of the servers started by this process
+        self._processes = {}
+        self.logger = logger.getChild('xvfb')
+        os.makedirs(state_dir, exist_ok=True)
+
+    @contextmanager
+    def _state(self):
+        """Yields the pool state while holding the pool lock, then saves it.
+        """
+        import fcntl
+
+        with open(os.path.join(self.state_dir, 'pool.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            path = os.path.join(self.state_dir, 'pool.json')
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+            except (IOError, ValueError):
+                state = {}
+            for display in self.displays:
+                entry = state.setdefault(
+                    str(display), {'pid': None, 'lessees': [], 'uses': 0})
+                entry['lessees'] = [
+                    pid for pid in entry.get('lessees', [])
+                    if self._is_alive(pid)
+                ]
+                entry.pop('leases', None)
+            yield state
+            with open(path + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.rename(path + '.tmp', path)
+
+    @staticmethod
+    def _is_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except PermissionError:
+            return True
+        except OSError:
+            return False
+        try:
+            # an exited server not reaped yet by the process that started it
+            with open('/proc/%d/stat' % pid) as f:
+                return f.read().rpartition(')')[2].split()[0] != 'Z'
+        except (IOError, IndexError):
+            return True
+
+    @staticmethod
+    def _is_healthy(display, entry):
+        if entry['pid'] is None:
+            return False
+        try:
+            os.kill(entry['pid'], 0)
+        except OSError:
+            return False
+        return os.path.exists('/tmp/.X11-unix/X%d' % display)
+
+    def _start_server(self, display, entry):
+        self._stop_server(display, entry)
+        self.logger.info('Starting Xvfb on :%d', display)
+        try:
+            process = subprocess.Popen(
+                [
+                    'Xvfb', ':%d' % display,
+                    '-screen', '0', '%dx%dx24' % tuple(self.display_size),
+                    '-nolisten', 'tcp',
+                ],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        except OSError:
+            raise Error('Xvfb is required to a ghost run outside ' +
+                        'an X instance')
+        self._processes[display] = process
+        entry.update(pid=process.pid, lessees=[], uses=0)
+
+        started_at = time.time()
+        while not self._is_healthy(display, entry):
+            if process.poll() is not None:
+                raise Error('Xvfb exited while starting on :%d' % display)
+            if time.time() > started_at + self.start_timeout:
+                raise Error('Xvfb did not start on :%d' % display)
+            time.sleep(0.05)
+
+    def _stop_server(self, display, entry):
+        """Stops the server of a display and waits for it to exit, so that
+        its socket is not taken for a new server's."""
+        pid = entry['pid']
+        process = self._processes.pop(display, None)
+        if pid is not None:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+            if process is not None and process.pid == pid:
+                try:
+                    process.wait(self.start_timeout)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+            else:
+                # started by another process: poll until it is gone
+                deadline = time.time() + self.start_timeout
+                while self._is_alive(pid) and time.time() < deadline:
+                    time.sleep(0.05)
+                if self._is_alive(pid):
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+            # left behind when the server could not clean up
+            for path in ('/tmp/.X11-unix/X%d' % display, '/tmp/.X%d-lock' % display):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        entry.update(pid=None, lessees=[], uses=0)
+
+    def lease(self):
+        """Returns the number of the least used healthy display, starting
+        or restarting its server if needed.
+        """
+        with self._state() as state:
+            display = min(
+                self.displays, key=lambda d: len(state[str(d)]['lessees']))
+            entry = state[str(display)]
+            if not self._is_healthy(display, entry):
+                self._start_server(display, entry)
+            entry['lessees'].append(os.getpid())
+            entry['uses'] += 1
+        self.logger.debug('Leased display :%d', display)
+        return display
+
+    def release(self, display):
+        """Gives back a display obtained from `lease()`.
+
+        :param display: The display number.
+        """
+        with self._state() as state:
+            entry = state[str(display)]
+            if os.getpid() in entry['lessees']:
+                entry['lessees'].remove(os.getpid())
+            if (
+                self.max_uses is not None and
+                not entry['lessees'] and
+                entry['uses'] >= self.max_uses
+            ):
+                self.logger.info('Recycling Xvfb on :%d', display)
+                self._stop_server(display, entry)
+        self.logger.debug('Released display :%d', display)
+
+    def stop(self):
+        """Stops every server of the pool."""
+        with self._state() as state:
+            for display in self.displays:
+                self._stop_server(display, state[str(display)])
+
+
+def current_rss():
+    """Returns the resident set size of the process in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        import resource
+        # peak rather than current, but the best non-Linux platforms offer
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class MemoryWatchdog(object):
+    """Keeps long-running sessions at a flat memory profile.
+
+    `check()` is meant to run between jobs (a `Session` given a watchdog
+    calls it before each `open()`): it samples the process RSS and the
+    page's usage, clears WebKit memory caches and recycles the page
+    (see `Session.recycle_page()`) once a threshold is crossed.
+
+    :param max_rss: RSS in bytes above which the page is recycled.
+    :param max_navigations: Page loads after which the page is recycled.
+    :param max_page_bytes: Bytes held by the current page (as reported by
+        `QWebPage.totalBytes()`) above which it is recycled.
+    :param rss_navigations: Page loads a page must have served before
+        `max_rss` may recycle it. A fresh page does not always bring the
+        RSS back under `max_rss`, which would otherwise recycle it on
+        every load.
+    """
+    def __init__(
+        self, max_rss=None, max_navigations=None, max_page_bytes=None,
+        rss_navigations=10,
+    ):
+        self.max_rss = max_rss
+        self.max_navigations = max_navigations
+        self.max_page_bytes = max_page_bytes
+        self.rss_navigations = rss_navigations
+        self.last_sample = None
+
+    def check(self, session):
+        """Samples memory usage of a session, cleans up and recycles its
+        page if needed.
+
+        :param session: The `Session` to check.
+        :return: A dict with the sample and whether the page was recycled.
+        """
+        QWebSettings.clearMemoryCaches()
+        sample = dict(
+            rss=current_rss(),
+            navigations=session.navigations,
+            page_bytes=session.page.totalBytes(),
+            recycled=False,
+        )
+
+        if (
+            self.max_rss is not None and sample['rss'] > self.max_rss and
+            sample['navigations'] >= self.rss_navigations or
+            self.max_navigations is not None and sample['navigations'] >= self.max_navigations or
+            self.max_page_bytes is not None and sample['page_bytes'] > self.max_page_bytes
+        ):
+            session.logger.info('Memory threshold crossed %s, recycling page', sample)
+            session.recycle_page()
+            sample['recycled'] = True
+
+        self.last_sample = sample
+        return sample
+
+
+class Metrics(object):
+    """A registry of counters, gauges and histograms, rendered in the
+    Prometheus text exposition format.
+
+    Sessions and network access managers update the module `registry`
+    unless given their own. Gauges may be callables, sampled on render.
+
+    :param buckets: Upper bounds, in seconds, of histogram buckets.
+    """
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets=None):
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def describe(self, name, help):
+        """Sets the help text of a metric.
+
+        :param name: The metric name.
+        :param help: A one-line description.
+        """
+        self._help[name] = help
+
+    def inc(self, name, value=1):
+        """Increments a counter.
+
+        :param name: The metric name.
+        :param value: The amount to add.
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set(self, name, value):
+        """Sets a gauge.
+
+        :param name: The metric name.
+        :param value: A number, or a callable returning one on render.
+        """
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, value):
+        """Records a value in a histogram.
+
+        :param name: The metric name.
+        :param value: The observed value, in seconds for durations.
+        """
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = {
+                    'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0,
+                }
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, name):
+        """Observes the duration of the enclosed block in a histogram.
+
+        :param name: The metric name.
+        """
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started_at)
+
+    def _header(self, lines, name, kind):
+        if name in self._help:
+            lines.append('# HELP %s %s' % (name, self._help[name]))
+        lines.append('# TYPE %s %s' % (name, kind))
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            for name, value in sorted(self._counters.items()):
+                self._header(lines, name, 'counter')
+                lines.append('%s %s' % (name, value))
+            for name, value in sorted(self._gauges.items()):
+                self._header(lines, name, 'gauge')
+                lines.append('%s %s' % (name, value() if callable(value) else value))
+            for name, histogram in sorted(self._histograms.items()):
+                self._header(lines, name, 'histogram')
+                for bound, count in zip(self.buckets, histogram['buckets']):
+                    lines.append('%s_bucket{le="%s"} %s' % (name, bound, count))
+                lines.append('%s_bucket{le="+Inf"} %s' % (name, histogram['count']))
+                lines.append('%s_sum %s' % (name, histogram['sum']))
+                lines.append('%s_count %s' % (name, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=9108, host='127.0.0.1'):
+        """Exposes the metrics over HTTP from a daemon thread, so that they
+        stay available while the Qt event loop is busy.
+
+        :param port: The port to listen on.
+        :param host: The address to bind, local only by default.
+        :return: The HTTPServer, call its shutdown() to stop it.
+        """
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug('Metrics exporter: ' + format, *args)
+
+        server = HTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, name='ghost-metrics')
+        thread.daemon = True
+        thread.start()
+        logger.info('Serving metrics on http://%s:%d/metrics', host, port)
+        return server
+
+
+registry = Metrics()
+for _name, _help in (
+    ('ghost_pages_opened_total', 'Pages opened by sessions.'),
+    ('ghost_page_load_seconds', 'Time to load a page, from open() to loaded.'),
+    ('ghost_bytes_fetched_total', 'Bytes received by network access managers.'),
+    ('ghost_requests_blocked_total', 'Requests blocked by exclude rules or budgets.'),
+    ('ghost_capture_seconds', 'Time to render a page into an image.'),
+    ('ghost_encode_seconds', 'Time to encode and write a capture or document.'),
+    ('ghost_timeouts_total', 'TimeoutError raised while waiting on a page.'),
+    ('ghost_process_resident_bytes', 'Resident set size of the process.'),
+):
+    registry.describe(_name, _help)
+registry.set('ghost_process_resident_bytes', current_rss)
+del _name, _help
+
+
+class StageProfiler(object):
+    """Opt-in profiler breaking jobs (one page each) down into stages.
+
+    Stages are either timed blocks (`stage()`) or durations measured
+    elsewhere (`record()`); both use `time.perf_counter()`. A job may
+    also run under cProfile and tracemalloc, whose top entries end up in
+    the job report.
+
+    :param cprofile: Run each job under cProfile.
+    :param tracemalloc: Number of frames tracemalloc keeps per allocation,
+        0 to leave memory alone.
+    :param top: Number of cProfile and tracemalloc entries reported.
+    :param output: An optional path or text stream each job report is
+        appended to, as a JSON line.
+    """
+    def __init__(self, cprofile=False, tracemalloc=0, top=20, output=None):
+        self.cprofile = cprofile
+        self.tracemalloc = tracemalloc
+        self.top = top
+        self.output = output
+        self.jobs = []
+        self._job = None
+
+    def start_job(self, name):
+        """Starts profiling a job, ending the current one if any.
+
+        :param name: The job name, usually its URL.
+        """
+        if self._job is not None:
+            self.end_job()
+        self._job = job = dict(
+            name=name,
+            started_at=time.perf_counter(),
+            stages={},
+            profile=None,
+            snapshot=None,
+            started_tracing=False,
+        )
+        if self.tracemalloc:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.tracemalloc)
+                job['started_tracing'] = True
+            tracemalloc.reset_peak()
+            job['snapshot'] = tracemalloc.take_snapshot()
+        if self.cprofile:
+            import cProfile
+            job['profile'] = cProfile.Profile()
+            job['profile'].enable()
+
+    def record(self, name, seconds):
+        """Adds a duration to a stage of the current job.
+
+        :param name: The stage name.
+        :param seconds: The duration.
+        """
+        if self._job is None:
+            return
+        stage = self._job['stages'].setdefault(
+            name, {'count': 0, 'total': 0.0, 'max': 0.0})
+        stage['count'] += 1
+        stage['total'] += seconds
+        stage['max'] = max(stage['max'], seconds)
+
+    @contextmanager
+    def stage(self, name):
+        """Times the enclosed block as a stage of the current job.
+
+        :param name: The stage name.
+        """
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started_at)
+
+    def end_job(self):
+        """Ends the current job.
+
+        :return: The job report, a dict, or None without a current job.
+        """
+        job, self._job = self._job, None
+        if job is None:
+            return None
+
+        report = dict(
+            job=job['name'],
+            total=time.perf_counter() - job['started_at'],
+            stages=job['stages'],
+        )
+        if job['profile'] is not None:
+            job['profile'].disable()
+            import io
+            import pstats
+            text = io.StringIO()
+            pstats.Stats(job['profile'], stream=text).sort_stats(
+                'cumulative').print_stats(self.top)
+            report['profile'] = text.getvalue()
+        if job['snapshot'] is not None:
+            import tracemalloc
+            diff = tracemalloc.take_snapshot().compare_to(job['snapshot'], 'lineno')
+            report['memory'] = [str(stat) for stat in diff[:self.top]]
+            report['memory_peak'] = tracemalloc.get_traced_memory()[1]
+            if job['started_tracing']:
+                tracemalloc.stop()
+
+        self.jobs.append(report)
+        if self.output is not None:
+            line = json.dumps(report) + '\n'
+            if isinstance(self.output, str):
+                with open(self.output, 'a', encoding='utf-8') as f:
+                    f.write(line)
+            else:
+                self.output.write(line)
+        return report
+
+
+class CaptureCache(object):
+    """On-disk cache of captured images, so that a capture requested again
+    within `ttl` seconds is served without touching WebKit.
+
+    Entries are keyed by `key()`: the normalized url and everything else
+    that changes the picture. The least recently used entries are evicted
+    once the cache holds more than `max_bytes`. Writes are atomic, so
+    several processes may share a directory.
+
+    :param directory: The cache directory, created if needed.
+    :param max_bytes: Maximum total size of cached images.
+    :param ttl: Seconds an image stays valid.
+    """
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024, ttl=600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def normalize_url(url):
+        """Returns url with a lowercase scheme and host, no default port,
+        no fragment and sorted query parameters. User info and IPv6
+        literals are kept as such.
+
+        :param url: The url string.
+        """
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        host = (parts.hostname or '').lower()
+        if ':' in host:
+            host = '[%s]' % host
+        if parts.port and (scheme, parts.port) not in (('http', 80), ('https', 443)):
+            host = '%s:%d' % (host, parts.port)
+        userinfo, at, _ = parts.netloc.rpartition('@')
+        if at:
+            host = '%s@%s' % (userinfo, host)
+        query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+        return urlunsplit((scheme, host, parts.path or '/', query, ''))
+
+    def key(self, url, viewport, user_agent, cookies, format, **options):
+        """Returns the cache key of a capture.
+
+        :param url: The captured url.
+        :param viewport: The (width, height) of the viewport.
+        :param user_agent: The User-Agent string.
+        :param cookies: An iterable of (name, value) cookies sent.
+        :param format: The image format, e.g. 'png'.
+        :param options: Any other capture option changing the image.
+        """
+        cookies_hash = hashlib.sha256(
+            json.dumps(sorted(cookies)).encode('utf-8')).hexdigest()
+        return hashlib.sha256(json.dumps([
+            self.normalize_url(url), list(viewport), user_agent,
+            cookies_hash, format.lower(), options,
+        ], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key, path):
+        """Copies the cached image of `key` to `path`.
+
+        :param key: A key from `key()`.
+        :param path: The destination path.
+        :return: True on a cache hit, False otherwise.
+        """
+        entry = self._path(key)
+        try:
+            stat = os.stat(entry)
+        except OSError:
+            return False
+        now = time.time()
+        if now - stat.st_mtime > self.ttl:
+            self._remove(entry)
+            return False
+        try:
+            # atime tracks use (LRU), mtime creation (TTL)
+            os.utime(entry, (now, stat.st_mtime))
+            shutil.copyfile(entry, path)
+        except OSError:
+            # evicted meanwhile by another process sharing the directory
+            return False
+        logger.debug('Capture cache hit: %s', key)
+        return True
+
+    def put(self, key, path):
+        """Stores a copy of the image at `path` under `key`.
+
+        :param key: A key from `key()`.
+        :param path: The image to store.
+        """
+        entry = self._path(key)
+        tmp = '%s.%s.tmp' % (entry, uuid.uuid4().hex)
+        try:
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, entry)
+        except OSError:
+            self._remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Removes expired entries, then least recently used ones until
+        the cache fits in `max_bytes`."""
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                continue
+            entry = self._path(name)
+            try:
+                stat = os.stat(entry)
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.ttl:
+                self._remove(entry)
+            else:
+                entries.append((stat.st_atime, stat.st_size, entry))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(entry)
+            total -= size
+
+    @staticmethod
+    def _remove(entry):
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
+
+
 class Ghost(object):
     """`Ghost` manages a Qt application.
 
@@ -252,6 +1551,10 @@ class Ghost(object):
     :param plugin_path: Array with paths to plugin directories
         (default ['/usr/lib/mozilla/plugins'])
     :param defaults: The defaults arguments to pass to new child sessions.
+    :param platform: An optional Qt platform plugin name. 'offscreen' or
+        'minimal' run without any X server, so no Xvfb is started.
+    :param display_broker: An optional `XvfbBroker` to lease a display
+        from instead of starting a private Xvfb.
     """
     _app = None
 
@@ -260,26 +1563,31 @@ class Ghost(object):
         plugin_path=['/usr/lib/mozilla/plugins'],
         defaults=None,
         display_size=(1600, 900),
+        platform=None,
+        display_broker=None,
     ):
         self.logger = logger.getChild('application')
 
+        if platform is None:
+            platform = os.environ.get('QT_QPA_PLATFORM')
+
         if (
+            platform not in ('offscreen', 'minimal') and
             sys.platform.startswith('linux') and
             'DISPLAY' not in os.environ
         ):
-            try:
-                self.xvfb = Xvfb(
-                    width=display_size[0],
-                    height=display_size[1],
-                )
-                self.xvfb.start()
-
-            except OSError:
-                raise Error('Xvfb is required to a ghost run outside ' +
-                            'an X instance')
+            if display_broker is not None:
+                self.display_broker = display_broker
+                self.display = display_broker.lease()
+                os.environ['DISPLAY'] = ':%d' % self.display
+            else:
+                self._start_xvfb(display_size)
 
         self.logger.info('Initializing Qt application')
-        Ghost._app = QApplication.instance() or QApplication(['ghost'])
+        argv = ['ghost']
+        if platform is not None:
+            argv += ['-platform', platform]
+        Ghost._app = QApplication.instance() or QApplication(argv)
 
         qInstallMessageHandler(QTMessageProxy(logging.getLogger('qt')))
 
@@ -292,10 +1600,31 @@ class Ghost(object):
         _defaults.update(defaults or dict())
         self.defaults = _defaults
 
+    def _start_xvfb(self, display_size):
+        try:
+            # Imported here so that scripts running under an existing
+            # display don't pay for it.
+            from xvfbwrapper import Xvfb
+            self.xvfb = Xvfb(
+                width=display_size[0],
+                height=display_size[1],
+            )
+            self.xvfb.start()
+
+        except (ImportError, OSError):
+            raise Error('Xvfb is required to a ghost run outside ' +
+                        'an X instance')
+
     def exit(self):
         self._app.quit()
         if hasattr(self, 'xvfb'):
             self.xvfb.stop()
+        if hasattr(self, 'display_broker'):
+            # exit() runs again from __del__, release only once.
+            self.display_broker.release(self.display)
+            del self.display_broker
+            # only leased when DISPLAY was not set
+            os.environ.pop('DISPLAY', None)
 
     def start(self, **kwargs):
         """Starts a new `Session`."""
@@ -303,6 +1632,12 @@ class Ghost(object):
         _kwargs.update(kwargs)
         return Session(self, **_kwargs)
 
+    def start_async(self, **kwargs):
+        """Starts a new `AsyncSession`."""
+        _kwargs = self.defaults.copy()
+        _kwargs.update(kwargs)
+        return AsyncSession(self, **_kwargs)
+
     def __del__(self):
         self.exit()
 
@@ -327,6 +1662,28 @@ class Session(object):
         when sending a request
     :param local_storage_enabled: An optional boolean to enable / disable
         local storage.
+    :param cookie_store: An optional SQLite database path to keep cookies
+        in, shared with every session using the same path.
+    :param cookie_jar: An optional QNetworkCookieJar (e.g. a
+        `SharedCookieJar`) shared with other sessions.
+    :param budget: An optional dict of `ResourceBudget` limits applied to
+        every page opened; see `budget.exceeded` after loading.
+    :param fast_capture: Block media, web fonts, iframes and beacons, and
+        disable plugins and CSS animations, for text-oriented captures.
+    :param network_access_manager: An optional `NetworkAccessManager`
+        instance shared with other sessions, so that they reuse the same
+        connections and cache. Its own options (exclude regex, proxy, cookie
+        jar unless `cookie_jar` or `cookie_store` is given) apply to all of
+        them.
+    :param memory_watchdog: An optional `MemoryWatchdog` checked before
+        each page is opened.
+    :param metrics: The `Metrics` registry to update, the module's
+        `registry` by default.
+    :param profiler: An optional `StageProfiler`. Each `open()` starts a
+        job with stages network (until loaded), layout (until the first
+        layout), js, render and save.
+    :param capture_cache: An optional `CaptureCache` used by
+        `capture_url_to()`, and by `capture_to()` when asked to.
     """
     _alert = None
     _confirm_expected = None
@@ -352,12 +1709,21 @@ class Session(object):
         network_access_manager_class=NetworkAccessManager,
         web_page_class=GhostWebPage,
         local_storage_enabled=True,
+        cookie_store=None,
+        cookie_jar=None,
+        budget=None,
+        fast_capture=False,
+        network_access_manager=None,
+        memory_watchdog=None,
+        metrics=None,
+        profiler=None,
+        capture_cache=None,
     ):
         self.ghost = ghost
 
         self.id = str(uuid.uuid4())
 
-        self.logger = logging.LoggerAdapter(
+        self.logger = SessionLoggerAdapter(
             logger.getChild('session'),
             {'session': self.id},
         )
@@ -367,6 +1733,16 @@ class Session(object):
 
         self.wait_timeout = wait_timeout
         self.wait_callback = wait_callback
+        self.memory_watchdog = memory_watchdog
+        self.navigations = 0
+        self.metrics = registry if metrics is None else metrics
+        self.profiler = profiler
+        self.capture_cache = capture_cache
+        self._load_started_at = None
+        self._laid_out = False
+        self._painted = False
+        # set by AsyncSession: signal handlers must not hold the event loop
+        self._nonblocking = False
         self.ignore_ssl_errors = ignore_ssl_errors
         self.loaded = True
 
@@ -375,8 +1751,18 @@ class Session(object):
         self.popup_messages = []
         self.page = web_page_class(self.ghost._app, self)
 
-        if network_access_manager_class is not None:
-            self.page.setNetworkAccessManager(network_access_manager_class(exclude_regex=exclude))
+        if fast_capture:
+            plugins_enabled = java_enabled = False
+
+        self._shared_manager = network_access_manager is not None
+        if self._shared_manager:
+            self.page.setNetworkAccessManager(network_access_manager)
+        elif network_access_manager_class is not None:
+            manager_kwargs = dict(exclude_regex=exclude, metrics=self.metrics)
+            if fast_capture:
+                manager_kwargs['block_subframes'] = True
+                manager_kwargs['fast_capture'] = True
+            self.page.setNetworkAccessManager(network_access_manager_class(**manager_kwargs))
 
         QWebSettings.setMaximumPagesInCache(0)
         QWebSettings.setObjectCacheCapacities(0, 0, 0)
@@ -387,6 +1773,10 @@ class Session(object):
         self.page.settings().setAttribute(QWebSettings.PluginsEnabled, plugins_enabled)
         self.page.settings().setAttribute(QWebSettings.JavaEnabled, java_enabled)
         self.page.settings().setAttribute(QWebSettings.JavascriptEnabled, javascript_enabled)
+        if fast_capture:
+            self.page.settings().setUserStyleSheetUrl(QUrl(
+                'data:text/css;charset=utf-8;base64,' +
+                base64.b64encode(NO_ANIMATION_CSS.encode('utf-8')).decode('ascii')))
 
         if not show_scrollbars:
             self.page.mainFrame().setScrollBarPolicy(Qt.Vertical, Qt.ScrollBarAlwaysOff, )
@@ -396,14 +1786,32 @@ class Session(object):
         self.page.loadFinished.connect(self._page_loaded)
         self.page.loadStarted.connect(self._page_load_started)
         self.page.unsupportedContent.connect(self._unsupported_content)
+        self.page.mainFrame().loadStarted.connect(self._main_frame_load_started)
+        self.page.mainFrame().initialLayoutCompleted.connect(self._initial_layout_completed)
+        self.page.repaintRequested.connect(self._repaint_requested)
 
         self.manager = self.page.networkAccessManager()
         self.manager.finished.connect(self._request_ended)
+
+        # looked up by NetworkAccessManager through the page's session
+        self.budget = ResourceBudget(**budget) if budget else None
         self.manager.sslErrors.connect(self._on_manager_ssl_errors)
 
         # Cookie jar
-        self.cookie_jar = QNetworkCookieJar()
-        self.manager.setCookieJar(self.cookie_jar)
+        if cookie_jar is not None:
+            self.cookie_jar = cookie_jar
+        elif cookie_store is not None:
+            self.cookie_jar = SQLiteCookieJar(cookie_store)
+        elif self._shared_manager:
+            self.cookie_jar = self.manager.cookieJar()
+        else:
+            self.cookie_jar = QNetworkCookieJar()
+        if self.cookie_jar is not self.manager.cookieJar():
+            self.manager.setCookieJar(self.cookie_jar)
+        if cookie_jar is not None:
+            # The manager takes ownership of its jar; a shared one must
+            # outlive this session.
+            self.cookie_jar.setParent(None)
 
         # User Agent
         self.page.set_user_agent(user_agent)
@@ -413,21 +1821,12 @@ class Session(object):
 
         self.main_frame = self.page.mainFrame()
 
-        class GhostQWebView(QWebView):
-            def sizeHint(self):
-                return QSize(*viewport_size)
-
-        self.webview = GhostQWebView()
+        # A QWebView is only created by show(); headless sessions render
+        # straight from the QWebPage.
+        self.webview = None
 
         self.set_viewport_size(*viewport_size)
 
-        if plugins_enabled:
-            self.webview.settings().setAttribute(QWebSettings.PluginsEnabled, True)
-        if java_enabled:
-            self.webview.settings().setAttribute(QWebSettings.JavaEnabled, True)
-
-        self.webview.setPage(self.page)
-
         if self.display:
             self.show()
 
@@ -476,6 +1875,9 @@ class Session(object):
         region=None,
         selector=None,
         format=None,
+        idle_ms=None,
+        full_page=True,
+        max_inflight=0,
     ):
         """Returns snapshot as QImage.
 
@@ -483,10 +1885,21 @@ class Session(object):
             coordinates.
         :param selector: A selector targeted the element to crop on.
         :param format: The output image format.
+        :param idle_ms: If set, wait for the network to be idle for that
+            many milliseconds before capturing, at most `wait_timeout`
+            seconds: a page that never goes idle is captured anyway.
+        :param max_inflight: Number of requests allowed to be still
+            running when waiting for `idle_ms`, e.g. long polling.
+        :param full_page: Grow the viewport to the whole page first. When
+            False only the current viewport is rendered, without the
+            full-height relayout.
         """
         if format is None:
             format = QImage.Format_ARGB32_Premultiplied
 
+        if idle_ms is not None:
+            self._wait_before_capture(idle_ms, max_inflight)
+
         self.main_frame.setScrollBarPolicy(
             Qt.Vertical,
             Qt.ScrollBarAlwaysOff,
@@ -495,33 +1908,35 @@ class Session(object):
             Qt.Horizontal,
             Qt.ScrollBarAlwaysOff,
         )
-        frame_size = self.main_frame.contentsSize()
-        max_size = 23170 * 23170
-        if frame_size.height() * frame_size.width() > max_size:
-            self.logger.warning("Frame size is too large.")
-            default_size = self.page.viewportSize()
-            if default_size.height() * default_size.width() > max_size:
-                return None
-        else:
-            self.page.setViewportSize(self.main_frame.contentsSize())
+        if full_page:
+            frame_size = self.main_frame.contentsSize()
+            max_size = 23170 * 23170
+            if frame_size.height() * frame_size.width() > max_size:
+                self.logger.warning("Frame size is too large.")
+                default_size = self.page.viewportSize()
+                if default_size.height() * default_size.width() > max_size:
+                    return None
+            else:
+                self.page.setViewportSize(self.main_frame.contentsSize())
 
         self.logger.info("Frame size -> %s", str(self.page.viewportSize()))
 
-        image = QImage(self.page.viewportSize(), format)
-        painter = QPainter(image)
-
         if region is None and selector is not None:
             region = self.region_for_selector(selector)
 
-        if region:
-            x1, y1, x2, y2 = region
-            w, h = (x2 - x1), (y2 - y1)
-            reg = QRegion(x1, y1, w, h)
-            self.main_frame.render(painter, reg)
-        else:
-            self.main_frame.render(painter)
+        with self.metrics.timer('ghost_capture_seconds'), self._stage('render'):
+            image = QImage(self.page.viewportSize(), format)
+            painter = QPainter(image)
 
-        painter.end()
+            if region:
+                x1, y1, x2, y2 = region
+                w, h = (x2 - x1), (y2 - y1)
+                reg = QRegion(x1, y1, w, h)
+                self.main_frame.render(painter, reg)
+            else:
+                self.main_frame.render(painter)
+
+            painter.end()
 
         if region:
             x1, y1, x2, y2 = region
@@ -536,6 +1951,10 @@ class Session(object):
         region=None,
         selector=None,
         format=None,
+        idle_ms=None,
+        full_page=True,
+        use_cache=False,
+        max_inflight=0,
     ):
         """Saves snapshot as image.
 
@@ -544,11 +1963,250 @@ class Session(object):
             coordinates.
         :param selector: A selector targeted the element to crop on.
         :param format: The output image format.
+        :param idle_ms: If set, wait for the network to be idle for that
+            many milliseconds before capturing, see `capture()`.
+        :param max_inflight: Requests allowed to be still running when
+            waiting for `idle_ms`.
+        :param full_page: Grow the viewport to the whole page first, see
+            `capture()`.
+        :param use_cache: Look the image up in the capture cache, and store
+            it there. The cache only knows the url: leave it off once the
+            page was changed by scripts or interactions.
+        """
+        if format is None:
+            format = QImage.Format_ARGB32_Premultiplied
+
+        cache_key = None
+        if use_cache and self.capture_cache is not None:
+            cache_key = self._capture_cache_key(
+                self.main_frame.requestedUrl().toString(), path,
+                region=region, selector=selector, format=format,
+                full_page=full_page,
+            )
+            if self.capture_cache.get(cache_key, path):
+                return
+
+        image = self.capture(
+            region=region,
+            format=format,
+            selector=selector,
+            idle_ms=idle_ms,
+            full_page=full_page,
+            max_inflight=max_inflight,
+        )
+        with self.metrics.timer('ghost_encode_seconds'), self._stage('save'):
+            image.save(path)
+
+        if cache_key is not None:
+            self.capture_cache.put(cache_key, path)
+
+    def capture_url_to(self, address, path, timeout=None, **kwargs):
+        """Opens a page and saves its snapshot, unless the capture cache
+        already holds it, in which case the page is not loaded at all.
+
+        :param address: The resource URL.
+        :param path: The destination path.
+        :param timeout: An optional timeout for the page load.
+        :param kwargs: `capture_to()` arguments.
+        :return: True if the image came from the cache.
+        """
+        cache_key = None
+        if self.capture_cache is not None:
+            cache_key = self._capture_cache_key(
+                address, path,
+                region=kwargs.get('region'),
+                selector=kwargs.get('selector'),
+                format=kwargs.get('format'),
+                full_page=kwargs.get('full_page', True),
+            )
+            if self.capture_cache.get(cache_key, path):
+                return True
+
+        self.open(address, timeout=timeout)
+        self.capture_to(path, **kwargs)
+        if cache_key is not None:
+            self.capture_cache.put(cache_key, path)
+        return False
+
+    def _capture_cache_key(self, url, path, format=None, **options):
+        """Returns the `CaptureCache` key of a capture of this session."""
+        if format is None:
+            format = QImage.Format_ARGB32_Premultiplied
+        size = self.page.preferredContentsSize()
+        cookies = [
+            (bytes(cookie.name()).decode('utf-8', 'replace'),
+             bytes(cookie.value()).decode('utf-8', 'replace'))
+            for cookie in self.cookie_jar.cookiesForUrl(QUrl(url))
+        ]
+        return self.capture_cache.key(
+            url,
+            (size.width(), size.height()),
+            self.page.user_agent,
+            cookies,
+            os.path.splitext(path)[1].lstrip('.') or 'png',
+            qimage_format=int(format),
+            **options
+        )
+
+    def _wait_before_capture(self, idle_ms, max_inflight=0):
+        """Waits for the network to be idle, like WebKitShooter does before
+        a capture: after `wait_timeout` seconds the page is captured as it
+        is rather than not at all.
+        """
+        try:
+            self.wait_for_network_idle(idle_ms, max_inflight)
+        except TimeoutError:
+            self.logger.warning(
+                'Network still busy after %ss, capturing anyway',
+                self.wait_timeout,
+            )
+
+    def capture_elements(
+        self,
+        selectors,
+        format=None,
+        idle_ms=None,
+    ):
+        """Captures several elements with a single render of the area
+        they cover, instead of one full render per `capture(selector=...)`.
+
+        :param selectors: An iterable of selectors.
+        :param format: The output image format.
+        :param idle_ms: If set, wait for the network to be idle for that
+            many milliseconds before capturing.
+        :return: A dict mapping each selector to its QImage, or to None
+            when it matches no visible element.
+        """
+        if format is None:
+            format = QImage.Format_ARGB32_Premultiplied
+
+        if idle_ms is not None:
+            self._wait_before_capture(idle_ms)
+
+        self.main_frame.setScrollBarPolicy(Qt.Vertical, Qt.ScrollBarAlwaysOff)
+        self.main_frame.setScrollBarPolicy(Qt.Horizontal, Qt.ScrollBarAlwaysOff)
+        self.page.setViewportSize(self.main_frame.contentsSize())
+
+        regions = {}
+        for selector in selectors:
+            x1, y1, x2, y2 = self.region_for_selector(selector)
+            regions[selector] = (x1, y1, x2, y2) if x2 > x1 and y2 > y1 else None
+
+        found = [region for region in regions.values() if region is not None]
+        if not found:
+            return regions
+
+        left = min(region[0] for region in found)
+        top = min(region[1] for region in found)
+        right = max(region[2] for region in found)
+        bottom = max(region[3] for region in found)
+
+        clip = QRegion()
+        for x1, y1, x2, y2 in found:
+            clip = clip.united(QRegion(x1, y1, x2 - x1, y2 - y1))
+
+        with self.metrics.timer('ghost_capture_seconds'), self._stage('render'):
+            image = QImage(right - left, bottom - top, format)
+            image.fill(Qt.transparent)
+            painter = QPainter(image)
+            painter.translate(-left, -top)
+            self.main_frame.render(painter, clip)
+            painter.end()
+
+        return dict(
+            (selector, None if region is None else image.copy(
+                region[0] - left,
+                region[1] - top,
+                region[2] - region[0],
+                region[3] - region[1],
+            ))
+            for selector, region in regions.items()
+        )
+
+    def capture_thumbnails(
+        self,
+        widths,
+        above_the_fold=False,
+        format=None,
+        idle_ms=None,
+    ):
+        """Renders small previews of the page directly at scale, without
+        going through a full-size capture.
+
+        The largest thumbnail is painted through a scaled QPainter, the
+        others are reduced from it.
+
+        :param widths: An iterable of thumbnail widths, in pixels.
+        :param above_the_fold: Only preview the current viewport instead
+            of the whole page.
+        :param format: The output image format.
+        :param idle_ms: If set, wait for the network to be idle for that
+            many milliseconds before capturing.
+        :return: A dict mapping each width to its QImage.
         """
+        widths = sorted(set(widths), reverse=True)
+        if not widths or widths[-1] <= 0:
+            raise ValueError('thumbnail widths must be positive: %r' % widths)
+
         if format is None:
             format = QImage.Format_ARGB32_Premultiplied
 
-        self.capture(region=region, format=format, selector=selector).save(path)
+        if idle_ms is not None:
+            self._wait_before_capture(idle_ms)
+
+        self.main_frame.setScrollBarPolicy(Qt.Vertical, Qt.ScrollBarAlwaysOff)
+        self.main_frame.setScrollBarPolicy(Qt.Horizontal, Qt.ScrollBarAlwaysOff)
+        viewport_size = self.page.viewportSize()
+        try:
+            if not above_the_fold:
+                self.page.setViewportSize(self.main_frame.contentsSize())
+            size = self.page.viewportSize()
+            scale = float(widths[0]) / max(size.width(), 1)
+
+            with self.metrics.timer('ghost_capture_seconds'), self._stage('render'):
+                image = QImage(
+                    widths[0], max(1, int(size.height() * scale)), format)
+                painter = QPainter(image)
+                painter.setRenderHint(QPainter.SmoothPixmapTransform)
+                painter.scale(scale, scale)
+                self.main_frame.render(
+                    painter, QRegion(0, 0, size.width(), size.height()))
+                painter.end()
+        finally:
+            self.page.setViewportSize(viewport_size)
+
+        thumbnails = {widths[0]: image}
+        for width in widths[1:]:
+            thumbnails[width] = image.scaledToWidth(width, Qt.SmoothTransformation)
+        return thumbnails
+
+    def capture_viewports(
+        self,
+        sizes,
+        format=None,
+        idle_ms=None,
+    ):
+        """Captures the loaded page at several viewport sizes, resizing
+        and waiting for relayout instead of loading it again.
+
+        :param sizes: An iterable of (width, height) tuples.
+        :param format: The output image format.
+        :param idle_ms: If set, wait for the network to be idle for that
+            many milliseconds after each resize (e.g. for srcset images).
+        :return: A list of ((width, height), QImage) tuples.
+        """
+        viewport_size = self.page.viewportSize()
+        captures = []
+        try:
+            for width, height in sizes:
+                self.set_viewport_size(width, height)
+                captures.append((
+                    (width, height),
+                    self.capture(format=format, idle_ms=idle_ms),
+                ))
+        finally:
+            self.set_viewport_size(viewport_size.width(), viewport_size.height())
+        return captures
 
     def print_to_pdf(
         self,
@@ -573,7 +2231,7 @@ class Session(object):
             paper_units = QPrinter.Inch
 
         printer = QPrinter(mode=QPrinter.ScreenResolution)
-        printer.setOutputFromat(QPrinter.PdfFormat)
+        printer.setOutputFormat(QPrinter.PdfFormat)
         printer.setPaperSize(QSizeF(*paper_size), paper_units)
         printer.setPageMargins(*(paper_margins + (paper_units,)))
 
@@ -586,6 +2244,107 @@ class Session(object):
         self.webview.setZoomFactor(zoom_factor)
         self.webview.print_(printer)
 
+    def export_pdf(
+        self,
+        path,
+        paper_size=(8.5, 11.0),
+        paper_margins=(0, 0, 0, 0),
+        paper_units=None,
+        zoom_factor=1.0,
+    ):
+        """Saves the page as it is laid out on screen to a pdf file, one
+        paper page at a time.
+
+        Unlike `print_to_pdf()` (print media, one pass), only the area of
+        the current paper page is painted before the printer moves on, so
+        memory does not grow with the document length.
+
+        :param path: The destination path.
+        :param paper_size: A 2-tuple indicating size of page to print to.
+        :param paper_margins: A 4-tuple indicating size of each margins.
+        :param paper_units: Units for paper size, paper margins.
+        :param zoom_factor: Scale of the content, 1.0 fits the page width.
+        :return: The time, in seconds, spent on each page.
+        """
+        assert len(paper_size) == 2
+        assert len(paper_margins) == 4
+
+        if paper_units is None:
+            paper_units = QPrinter.Inch
+
+        printer = QPrinter(mode=QPrinter.ScreenResolution)
+        printer.setOutputFormat(QPrinter.PdfFormat)
+        printer.setPaperSize(QSizeF(*paper_size), paper_units)
+        printer.setPageMargins(*(paper_margins + (paper_units,)))
+        printer.setOutputFileName(path)
+
+        self.main_frame.setScrollBarPolicy(Qt.Vertical, Qt.ScrollBarAlwaysOff)
+        self.main_frame.setScrollBarPolicy(Qt.Horizontal, Qt.ScrollBarAlwaysOff)
+        viewport_size = self.page.viewportSize()
+        contents_size = self.main_frame.contentsSize()
+        self.page.setViewportSize(contents_size)
+
+        page_rect = printer.pageRect()
+        scale = zoom_factor * page_rect.width() / max(contents_size.width(), 1)
+        page_height = int(page_rect.height() / scale)
+        pages = max(1, -(-contents_size.height() // page_height))
+
+        painter = QPainter()
+        if not painter.begin(printer):
+            self.page.setViewportSize(viewport_size)
+            raise Error('Unable to write pdf to %s' % path)
+
+        timings = []
+        try:
+            painter.scale(scale, scale)
+            for index in range(pages):
+                started_at = time.perf_counter()
+                if index:
+                    printer.newPage()
+                top = index * page_height
+                painter.save()
+                painter.translate(0, -top)
+                with self._stage('render'):
+                    self.main_frame.render(
+                        painter,
+                        QRegion(0, top, contents_size.width(), page_height),
+                    )
+                painter.restore()
+                timings.append(time.perf_counter() - started_at)
+                self.logger.debug(
+                    "PDF page %d/%d in %.3fs", index + 1, pages, timings[-1])
+        finally:
+            painter.end()
+            self.page.setViewportSize(viewport_size)
+
+        self.logger.info("Saved %d pdf pages to %s", pages, path)
+        return timings
+
+    def export_pdfs(self, urls, path_template, timeout=None, **kwargs):
+        """Opens each url in turn and saves it with `export_pdf()`, reusing
+        this session (and its connections and caches) for all of them.
+
+        A url that fails to load or export is logged and skipped.
+
+        :param urls: An iterable of urls.
+        :param path_template: The destination of each pdf, formatted with
+            `index` and `url`, e.g. 'archive/{index:05d}.pdf'.
+        :param timeout: An optional timeout for each page load.
+        :param kwargs: `export_pdf()` arguments.
+        :return: A dict mapping urls to their per-page timings, or to the
+            exception that stopped them.
+        """
+        results = {}
+        for index, url in enumerate(urls):
+            path = path_template.format(index=index, url=url)
+            try:
+                self.open(url, timeout=timeout)
+                results[url] = self.export_pdf(path, **kwargs)
+            except Error as e:
+                self.logger.error("PDF export of %s failed: %s", url, e)
+                results[url] = e
+        return results
+
     @can_load_page
     def click(self, selector, btn=0):
         """Click the targeted element.
@@ -630,6 +2389,96 @@ class Session(object):
         else:
             return self.main_frame.toHtml()
 
+    def write_content(
+        self,
+        fileobj,
+        encoding='utf-8',
+        compress=None,
+        chunk_size=64 * 1024,
+    ):
+        """Writes current frame HTML to a file object, one top-level node
+        at a time, instead of building the whole document as one string.
+
+        QWebElement only walks elements: text and comment nodes that are
+        direct children of <html> or <body> are listed by a script and
+        written in between. Should scripts fail, such an element is
+        written as a whole instead.
+
+        :param fileobj: A binary file object opened for writing.
+        :param encoding: The encoding of the written document.
+        :param compress: An optional compression, 'gzip' or None.
+        :param chunk_size: Maximum number of bytes per write() call.
+        :return: The number of uncompressed bytes written.
+        """
+        if compress not in (None, 'gzip'):
+            raise ValueError('unsupported compression: %s' % compress)
+
+        out = fileobj
+        if compress == 'gzip':
+            out = gzip.GzipFile(fileobj=fileobj, mode='wb')
+
+        written = 0
+
+        def _write(text):
+            nonlocal written
+            data = text.encode(encoding)
+            for i in range(0, len(data), chunk_size):
+                out.write(data[i:i + chunk_size])
+            written += len(data)
+
+        def _open_tag(element):
+            attrs = ''.join(
+                ' %s="%s"' % (name, html.escape(element.attribute(name)))
+                for name in element.attributeNames()
+            )
+            return '<%s%s>' % (element.tagName().lower(), attrs)
+
+        def _children(element):
+            child = element.firstChild()
+            while not child.isNull():
+                yield child
+                child = child.nextSibling()
+
+        def _child_nodes(element):
+            # child elements as QWebElement, text and comments serialized
+            nodes = element.evaluateJavaScript(CHILD_NODES_JS)
+            if not isinstance(nodes, list):
+                yield element.toInnerXml()
+                return
+            elements = _children(element)
+            for kind, data in nodes:
+                if kind == 'element':
+                    yield next(elements)
+                elif kind == 'text':
+                    yield html.escape(data, quote=False)
+                else:
+                    yield '<!--%s-->' % data
+
+        started_at = time.time()
+        try:
+            doctype = self.main_frame.evaluateJavaScript(DOCTYPE_JS)
+            if doctype:
+                _write(doctype + '\n')
+            root = self.main_frame.documentElement()
+            _write(_open_tag(root))
+            for child in _child_nodes(root):
+                if isinstance(child, str):
+                    _write(child)
+                elif child.tagName().lower() == 'body':
+                    _write(_open_tag(child))
+                    for node in _child_nodes(child):
+                        _write(node if isinstance(node, str) else node.toOuterXml())
+                    _write('</body>')
+                else:
+                    _write(child.toOuterXml())
+            _write('</%s>' % root.tagName().lower())
+        finally:
+            if out is not fileobj:
+                out.close()
+            self.metrics.observe('ghost_encode_seconds', time.time() - started_at)
+
+        return written
+
     @property
     def cookies(self):
         """Returns all cookies."""
@@ -649,10 +2498,9 @@ class Session(object):
 
         :param script: The script to evaluate.
         """
-        return (
-            self.main_frame.evaluateJavaScript("%s" % script),
-            self._release_last_resources(),
-        )
+        with self._stage('js'):
+            result = self.main_frame.evaluateJavaScript("%s" % script)
+        return result, self._release_last_resources()
 
     def evaluate_js_file(self, path, encoding='utf-8', **kwargs):
         """Evaluates javascript file at given path in current frame.
@@ -674,6 +2522,16 @@ class Session(object):
     def exit(self):
         """Exits all Qt Widgets."""
         self.logger.info("Closing session")
+        if self.profiler is not None:
+            self.profiler.end_job()
+        if self._shared_manager:
+            # the manager outlives this session, stop it calling us back
+            self.manager.finished.disconnect(self._request_ended)
+            self.manager.sslErrors.disconnect(self._on_manager_ssl_errors)
+            self.manager.authenticationRequired.disconnect(self._authenticate)
+            self.manager.proxyAuthenticationRequired.disconnect(self._authenticate)
+            if hasattr(self.manager, 'forget_page'):
+                self.manager.forget_page(self.page)
         self.page.deleteLater()
         self.sleep()
         del self.webview
@@ -779,6 +2637,7 @@ class Session(object):
         timeout=None,
         encode_url=True,
         user_agent=None,
+        check_memory=True,
     ):
         """Opens a web page.
 
@@ -798,10 +2657,21 @@ class Session(object):
         :param timeout: An optional timeout.
         :param encode_url: Set to true if the url have to be encoded
         :param user_agent: An optional User-Agent string.
+        :param check_memory: Run the memory watchdog first, which may
+            recycle the page. Callers that already did, e.g. to connect
+            to the page that will load, pass False.
         :return: Page resource, and all loaded resources, unless wait
             is False, in which case it returns None.
         """
         self.logger.info('Opening %s', address)
+        if check_memory:
+            self._check_memory()
+        self.navigations += 1
+        self.metrics.inc('ghost_pages_opened_total')
+        if self.profiler is not None:
+            self.profiler.start_job(address)
+        if self.budget is not None:
+            self.budget.reset()
         body = body or QByteArray()
         try:
             method = getattr(QNetworkAccessManager, "%sOperation" % method.capitalize())
@@ -821,6 +2691,9 @@ class Session(object):
         self._auth = auth
         self._auth_attempt = 0  # Avoids reccursion
 
+        self._load_started_at = time.perf_counter()
+        # also reset on loadStarted, for navigations not started here
+        self._laid_out = self._painted = False
         self.main_frame.load(request, method, body)
         self.loaded = False
 
@@ -829,9 +2702,80 @@ class Session(object):
             self._confirm_expected = default_popup_response
 
         if wait:
-            print('waiting ... (in %d seconds)' % timeout)
+            self.logger.debug('Waiting for page load (timeout %s)', timeout)
             return self.wait_for_page_loaded(timeout=timeout)
 
+    def _check_memory(self):
+        """Runs the memory watchdog, if any; the page may be replaced."""
+        if self.memory_watchdog is not None:
+            self.memory_watchdog.check(self)
+
+    def recycle_page(self):
+        """Replaces the QWebPage with a fresh one, which gives back the
+        memory WebKit keeps growing over navigations.
+
+        The network access manager (and so cookies and connections),
+        settings, user agent and viewport are carried over; the current
+        document is not.
+        """
+        self.logger.info('Recycling page')
+        old_page = self.page
+        page = type(old_page)(self.ghost._app, self)
+
+        if self.manager.parent() is old_page:
+            # Qt's default manager belongs to the page, keep it alive
+            self.manager.setParent(None)
+        page.setNetworkAccessManager(self.manager)
+        page.set_user_agent(old_page.user_agent)
+        page.setForwardUnsupportedContent(True)
+
+        old_settings, settings = old_page.settings(), page.settings()
+        for attribute in (
+            QWebSettings.AutoLoadImages,
+            QWebSettings.PluginsEnabled,
+            QWebSettings.JavaEnabled,
+            QWebSettings.JavascriptEnabled,
+        ):
+            settings.setAttribute(attribute, old_settings.testAttribute(attribute))
+        settings.setUserStyleSheetUrl(old_settings.userStyleSheetUrl())
+
+        for orientation in (Qt.Vertical, Qt.Horizontal):
+            page.mainFrame().setScrollBarPolicy(
+                orientation,
+                old_page.mainFrame().scrollBarPolicy(orientation),
+            )
+
+        page.setPreferredContentsSize(old_page.preferredContentsSize())
+        page.setViewportSize(old_page.viewportSize())
+
+        page.loadFinished.connect(self._page_loaded)
+        page.loadStarted.connect(self._page_load_started)
+        page.unsupportedContent.connect(self._unsupported_content)
+        page.mainFrame().loadStarted.connect(self._main_frame_load_started)
+        page.mainFrame().initialLayoutCompleted.connect(self._initial_layout_completed)
+        page.repaintRequested.connect(self._repaint_requested)
+
+        self.page = page
+        self.main_frame = page.mainFrame()
+        if self.webview is not None:
+            self.webview.setPage(page)
+        if hasattr(self.manager, 'forget_page'):
+            self.manager.forget_page(old_page)
+
+        old_page.deleteLater()
+        self.navigations = 0
+        self._settle()
+
+    def warm_up(self, urls, connect=True):
+        """Resolves and pre-connects hosts before opening pages on them.
+
+        :param urls: Iterable of url strings.
+        :param connect: Open connections too, not only resolve names.
+        """
+        if not hasattr(self.manager, 'warm_up'):
+            raise Error('network access manager does not support warm up')
+        self.manager.warm_up(urls, connect=connect)
+
     def scroll_to_anchor(self, anchor):
         self.main_frame.scrollToAnchor(anchor)
 
@@ -1076,11 +3020,12 @@ class Session(object):
         """
         new_size = QSize(width, height)
 
-        self.webview.resize(new_size)
+        if self.webview is not None:
+            self.webview.resize(new_size)
         self.page.setPreferredContentsSize(new_size)
         self.page.setViewportSize(new_size)
 
-        self.sleep()
+        self._settle()
 
     def append_popup_message(self, message):
         self.popup_messages.append(str(message))
@@ -1088,9 +3033,21 @@ class Session(object):
     def show(self):
         """Show current page inside a QWebView."""
         self.logger.debug('Showing webview')
+        if self.webview is None:
+            self._create_webview()
         self.webview.show()
         self.sleep()
 
+    def _settle(self, value=0.1):
+        """Gives Qt time to process the events following a change.
+
+        Under an `AsyncSession`, Qt events are processed by its pump and
+        blocking here would stall the asyncio event loop, so it returns
+        at once.
+        """
+        if not self._nonblocking:
+            self.sleep(value)
+
     def sleep(self, value=0.1):
         started_at = time.time()
 
@@ -1110,8 +3067,10 @@ class Session(object):
 
         while not condition():
             if time.time() > (started_at + timeout):
+                self.metrics.inc('ghost_timeouts_total')
                 raise TimeoutError(timeout_message)
             self.sleep()
+            self._enforce_budget()
             if self.wait_callback is not None:
                 self.wait_callback()
 
@@ -1144,6 +3103,38 @@ class Session(object):
 
         return page, resources
 
+    def wait_for_first_paint(self, timeout=None):
+        """Waits until the page opened with `open(wait=False)` is laid out
+        and painted for the first time, which is usually well before it
+        is loaded. Follow with `capture(full_page=False)` to grab the
+        first screen.
+
+        :param timeout: An optional timeout.
+        """
+        self.wait_for(self._first_painted, 'Page was never painted', timeout)
+        return True, self._release_last_resources()
+
+    def wait_for_network_idle(self, idle_ms=500, max_inflight=0, timeout=None):
+        """Waits until no more than `max_inflight` requests are running and
+        none started or ended for `idle_ms` milliseconds.
+
+        Requires a network access manager keeping track of its requests,
+        like `NetworkAccessManager`.
+
+        :param idle_ms: Milliseconds the network must stay quiet.
+        :param max_inflight: Number of requests allowed to be still running.
+        :param timeout: An optional timeout.
+        """
+        if not hasattr(self.manager, 'is_idle'):
+            raise Error('network access manager does not track requests')
+
+        self.wait_for(
+            lambda: self.manager.is_idle(idle_ms, max_inflight, page=self.page),
+            'Network is still busy',
+            timeout,
+        )
+        return True, self._release_last_resources()
+
     def wait_for_selector(self, selector, timeout=None):
         """Waits until selector match an element on the frame.
 
@@ -1183,12 +3174,46 @@ class Session(object):
         )
         return True, self._release_last_resources()
 
+    def _enforce_budget(self):
+        """Stops the page load once the resource budget is exceeded."""
+        budget = self.budget
+        if budget is None or budget.stopped:
+            return
+
+        if (
+            budget.max_time is not None and
+            time.time() - budget.started_at > budget.max_time
+        ):
+            budget.exceed('max_time')
+        elif budget.max_dom_nodes is not None and budget.exceeded is None:
+            nodes = self.main_frame.evaluateJavaScript(
+                'document.getElementsByTagName("*").length')
+            if nodes and nodes > budget.max_dom_nodes:
+                budget.exceed('max_dom_nodes')
+
+        if budget.exceeded is not None:
+            self.logger.warning('Budget exceeded (%s), stopping page load', budget.exceeded)
+            budget.stopped = True
+            self.page.triggerAction(QWebPage.Stop)
+
+    def _create_webview(self):
+        """Creates the QWebView displaying the page."""
+        class GhostQWebView(QWebView):
+            def sizeHint(self):
+                return self.page().viewportSize()
+
+        self.webview = GhostQWebView()
+        self.webview.setPage(self.page)
+        self.webview.resize(self.page.viewportSize())
+
     def _authenticate(self, mix, authenticator):
         """Called back on basic / proxy http auth.
 
         :param mix: The QNetworkReply or QNetworkProxy object.
         :param authenticator: The QAuthenticator object.
         """
+        if hasattr(mix, 'request') and not self._owns_reply(mix):
+            return
         if self._auth is not None and self._auth_attempt == 0:
             username, password = self._auth
             authenticator.serUser(username)
@@ -1198,7 +3223,39 @@ class Session(object):
     def _page_loaded(self):
         """Called back when page loaded."""
         self.loaded = True
-        self.sleep()
+        if self._load_started_at is not None:
+            elapsed = time.perf_counter() - self._load_started_at
+            self.metrics.observe('ghost_page_load_seconds', elapsed)
+            if self.profiler is not None:
+                self.profiler.record('network', elapsed)
+            self._load_started_at = None
+        self._settle()
+
+    def _main_frame_load_started(self):
+        """Called back when the main frame starts loading a document, be it
+        from `open()`, a click or a script."""
+        self._laid_out = self._painted = False
+
+    def _initial_layout_completed(self):
+        """Called back when the main frame is first laid out."""
+        self._laid_out = True
+        if self.profiler is not None and self._load_started_at is not None:
+            self.profiler.record('layout', time.perf_counter() - self._load_started_at)
+
+    def _repaint_requested(self, rect):
+        """Called back when a headless page has something to paint."""
+        if self._laid_out:
+            self._painted = True
+
+    def _first_painted(self):
+        # a QWebView paints the page itself, no repaint is requested then
+        return self._painted or (self._laid_out and self.webview is not None)
+
+    def _stage(self, name):
+        """Returns a context manager timing a profiler stage, if any."""
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.stage(name)
 
     def _page_load_started(self):
         """Called back when page load started."""
@@ -1213,11 +3270,23 @@ class Session(object):
         self.http_resources = []
         return last_resources
 
+    def _owns_reply(self, reply):
+        """Tells if a reply belongs to this session's page, which matters
+        when the network access manager is shared.
+
+        :param reply: The QNetworkReply object.
+        """
+        if not self._shared_manager:
+            return True
+        return page_for_request(reply.request()) is self.page
+
     def _request_ended(self, reply):
         """Adds an HttpResource object to http_resources.
 
         :param reply: The QNetworkReply object.
         """
+        if not self._owns_reply(reply):
+            return
         if reply.attribute(QNetworkRequest.HttpStatusCodeAttribute):
             self.logger.debug("[%s] bytesAvailable()=%s",
                               str(reply.url()),
@@ -1253,6 +3322,8 @@ class Session(object):
             ))
 
     def _on_manager_ssl_errors(self, reply, errors):
+        if not self._owns_reply(reply):
+            return
         url = str(reply.url().toString())
         if self.ignore_ssl_errors:
             reply.ignoreSslErrors()
@@ -1264,3 +3335,217 @@ class Session(object):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.exit()
+
+
+class AsyncSession(object):
+    """asyncio front-end of a `Session`.
+
+    Waiting is done with awaitables instead of `Session.sleep()`, and Qt
+    events are pumped by one task per event loop, so every `AsyncSession`
+    of a process makes progress concurrently with other coroutines. All
+    calls must be made from the thread running the Qt application.
+
+    The pump runs again as soon as Qt has posted events left, and backs
+    off to `pump_interval` while Qt is idle. An event loop that already
+    runs the Qt one (e.g. qasync's `QEventLoop`) needs no pump at all:
+    pass `pump_interval=None`.
+
+    Methods without an async counterpart are forwarded to the wrapped
+    `Session` as is.
+
+    :param ghost: The parent `Ghost` instance.
+    :param pump_interval: Longest time in seconds between two Qt event
+        pumps, or None for no pump.
+    :param kwargs: The `Session` arguments.
+    """
+    _pumps = {}
+
+    def __init__(self, ghost, pump_interval=0.01, **kwargs):
+        self.session = Session(ghost, **kwargs)
+        self.session._nonblocking = True
+        self.pump_interval = pump_interval
+        self._poll_interval = pump_interval or 0.01
+        self._loop = None
+
+    def __getattr__(self, name):
+        if name == 'session':
+            raise AttributeError(name)
+        return getattr(self.session, name)
+
+    def _ensure_pump(self):
+        """Starts the Qt event pump of the running loop if needed."""
+        if self._loop is not None:
+            return
+        self._loop = asyncio.get_event_loop()
+        if self.pump_interval is None:
+            return
+        task, users = AsyncSession._pumps.get(self._loop, (None, 0))
+        if task is None:
+            task = self._loop.create_task(
+                self._pump(self.session.ghost._app, self.pump_interval))
+        AsyncSession._pumps[self._loop] = (task, users + 1)
+
+    @staticmethod
+    async def _pump(app, interval):
+        delay = 0
+        while True:
+            app.processEvents()
+            if app.hasPendingEvents():
+                # events posted while processing: run again once other
+                # tasks had their turn
+                delay = 0
+            else:
+                delay = min(interval, max(delay * 2, 0.001))
+            await asyncio.sleep(delay)
+
+    async def wait_for(self, condition, timeout_message, timeout=None):
+        """Waits until condition is True.
+
+        :param condition: A callable that returns the condition.
+        :param timeout_message: The exception message on timeout.
+        :param timeout: An optional timeout.
+        """
+        self._ensure_pump()
+        timeout = self.session.wait_timeout if timeout is None else timeout
+        started_at = time.time()
+
+        while not condition():
+            if time.time() > (started_at + timeout):
+                self.session.metrics.inc('ghost_timeouts_total')
+                raise TimeoutError(timeout_message)
+            await asyncio.sleep(self._poll_interval)
+            self.session._enforce_budget()
+            if self.session.wait_callback is not None:
+                self.session.wait_callback()
+
+    async def open(self, address, timeout=None, **kwargs):
+        """Opens a web page and waits for it to be loaded.
+
+        :param address: The resource URL.
+        :param timeout: An optional timeout.
+        :param kwargs: The other `Session.open()` arguments.
+        :return: Page resource, and all loaded resources.
+        """
+        self._ensure_pump()
+        loaded = self._loop.create_future()
+
+        def _load_finished(ok):
+            if not loaded.done():
+                loaded.set_result(ok)
+
+        timeout = self.session.wait_timeout if timeout is None else timeout
+        # the watchdog may recycle the page: connect to the one that loads
+        self.session._check_memory()
+        page = self.session.page
+        page.loadFinished.connect(_load_finished)
+        try:
+            self.session.open(
+                address, wait=False, check_memory=False, **kwargs)
+            started_at = time.time()
+            while not loaded.done():
+                if time.time() > (started_at + timeout):
+                    self.session.metrics.inc('ghost_timeouts_total')
+                    raise TimeoutError('Unable to load requested page')
+                # wakes up on load, or in time to enforce the budget
+                await asyncio.wait([loaded], timeout=self._poll_interval)
+                self.session._enforce_budget()
+                if self.session.wait_callback is not None:
+                    self.session.wait_callback()
+        finally:
+            page.loadFinished.disconnect(_load_finished)
+
+        return self.session.wait_for_page_loaded()
+
+    async def wait_for_network_idle(self, idle_ms=500, max_inflight=0, timeout=None):
+        """Waits until the network is quiet, see
+        `Session.wait_for_network_idle()`.
+        """
+        if not hasattr(self.session.manager, 'is_idle'):
+            raise Error('network access manager does not track requests')
+
+        await self.wait_for(
+            lambda: self.session.manager.is_idle(
+                idle_ms, max_inflight, page=self.session.page),
+            'Network is still busy',
+            timeout,
+        )
+        return True, self.session._release_last_resources()
+
+    async def wait_for_selector(self, selector, timeout=None):
+        """Waits until selector match an element on the frame.
+
+        :param selector: The selector to wait for.
+        :param timeout: An optional timeout.
+        """
+        await self.wait_for(
+            lambda: self.session.exists(selector),
+            'Can\'t find element matching "%s"' % selector,
+            timeout,
+        )
+        return True, self.session._release_last_resources()
+
+    async def wait_while_selector(self, selector, timeout=None):
+        """Waits until the selector no longer matchies an element on the frame.
+
+        :param selector: The selector to wait for.
+        :param timeout: An optional timeout.
+        """
+        await self.wait_for(
+            lambda: not self.session.exists(selector),
+            'Element matching "%s" is still available' % selector,
+            timeout,
+        )
+        return True, self.session._release_last_resources()
+
+    async def wait_for_text(self, text, timeout=None):
+        """Waits until given text appear on main frame.
+
+        :param text: The text to wait for.
+        :param timeout: An optional timeout.
+        """
+        await self.wait_for(
+            lambda: text in self.session.content,
+            'Can\'t find "%s" in current frame' % text,
+            timeout,
+        )
+        return True, self.session._release_last_resources()
+
+    async def wait_for_first_paint(self, timeout=None):
+        """Waits until the page is first painted, see
+        `Session.wait_for_first_paint()`.
+        """
+        await self.wait_for(
+            self.session._first_painted,
+            'Page was never painted',
+            timeout,
+        )
+        return True, self.session._release_last_resources()
+
+    async def capture(self, **kwargs):
+        """Returns snapshot as QImage, see `Session.capture()`."""
+        # Rendering has to happen on the Qt thread; yield first so other
+        # pages get a chance to progress.
+        await asyncio.sleep(0)
+        return self.session.capture(**kwargs)
+
+    async def capture_to(self, path, **kwargs):
+        """Saves snapshot as image, see `Session.capture_to()`."""
+        await asyncio.sleep(0)
+        return self.session.capture_to(path, **kwargs)
+
+    def exit(self):
+        """Exits the session and stops the event pump once unused."""
+        if self._loop is not None and self.pump_interval is not None:
+            task, users = AsyncSession._pumps.pop(self._loop)
+            if users > 1:
+                AsyncSession._pumps[self._loop] = (task, users - 1)
+            else:
+                task.cancel()
+        self._loop = None
+        self.session.exit()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.exit()
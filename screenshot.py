@@ -6,7 +6,7 @@ How to use
 
   $ python screenshot.py -h
   usage: screenshot.py [-h] [-a AGENT] [-l LANGUAGE] [-w WIDTH] [-H HEIGHT]
-                       [-p PREFIX] [-s]
+                       [-p PREFIX] [-s] [-j]
                        url
 
   positional arguments:
@@ -27,10 +27,13 @@ How to use
     -s, --with-smooth-scroll
                           whether scroll down to bottom when capture the page or
                           not
+    -j, --log-json        write logs as JSON lines, from a background thread
 
 """
 import datetime
+import logging
 import sys
+import time
 
 from argparse import ArgumentParser
 
@@ -50,6 +53,7 @@ except ImportError:
     from PyQt5.QtWebKitWidgets import QWebView, QWebPage
     from PyQt5.QtWidgets import QApplication
 
+logger = logging.getLogger(__name__)
 
 DEFAULT_WIDTH = 1024
 DEFAULT_HEIGHT = 768
@@ -57,6 +61,9 @@ DEFAULT_USERAGENT = ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_5)'
                      ' AppleWebKit/537.36 (KHTML, like Gecko)'
                      ' CDP/47.0.2526.73 Safari/537.36')
 DEFAULT_PREFIX = 'screenshot'
+SCROLL_STEP_TIMEOUT = 1.0  # longest wait (s) for lazy images per screen
+PENDING_IMAGES_JS = ('Array.prototype.filter.call(document.images,'
+                     ' function (img) { return !img.complete; }).length')
 
 
 class Page(QWebPage):
@@ -83,22 +90,23 @@ class Browser(QWebView):
             self.setPage(page)
 
         self.use_smooth_scroll = args.with_smooth_scroll
-        self.scrollStarted = False
+        self.scrollStartedAt = None
+        self.lastContentHeight = None
         self.initialize()
 
     def _private_browse(self):
-        print("Enable private browsing mode")
+        logger.info("Enable private browsing mode")
         self.settings().setAttribute(QWebSettings.PrivateBrowsingEnabled, True)
 
     def _hide_scroll_bars(self):
-        print("Disable scroll bars")
+        logger.info("Disable scroll bars")
         self.page().mainFrame().setScrollBarPolicy(Qt.Horizontal, Qt.ScrollBarAlwaysOff)
 
     def initialize(self):
         self.timerDelay = QTimer()
-        self.timerDelay.setInterval(50)
+        self.timerDelay.setInterval(20)
         self.timerDelay.setSingleShot(True)
-        self.timerDelay.timeout.connect(self.delay_action)
+        self.timerDelay.timeout.connect(self.scroll_settled)
 
         self.loadFinished.connect(self.load_finished_slot)
         self.loadProgress.connect(self.load_progress_slot)
@@ -109,40 +117,48 @@ class Browser(QWebView):
     def load_progress_slot(self, progress):
         """Callback function when content loading status updated.
         """
-        print("Loading progress: {:d}%...".format(progress))
+        logger.debug("Loading progress: %d%%...", progress)
 
     def load_finished_slot(self, ok):
         """Callback function when content loading finished
         """
         if not ok:
-            print("Loaded but not completed: {}".format(self.url))
+            logger.info("Loaded but not completed: %s", self.url)
             return
-        print("Load completed: {}".format(self.url))
-        print("Loaded content size: {:,d} x {:,d}".format(
-            self.page().mainFrame().contentsSize().width(),
-            self.page().mainFrame().contentsSize().height(),
-        ))
+        logger.info("Load completed: %s", self.url)
+        logger.info("Loaded content size: %d x %d",
+                    self.page().mainFrame().contentsSize().width(),
+                    self.page().mainFrame().contentsSize().height())
         self.delay_action()
 
     def delay_action(self):
         frame = self.page().mainFrame()
         target_y = frame.scrollBarMaximum(Qt.Vertical)
         current_y = frame.scrollBarValue(Qt.Vertical)
-        print("target: {:d}, current: {:d}".format(target_y, current_y))
-
-        if self.use_smooth_scroll:
-            y = current_y - 50 if self.scrollStarted else target_y
-            if y > 0:
-                frame.evaluateJavaScript("window.scrollTo(0, {:d});".format(y))
-                print("Scroll to y: {:,d}".format(y))
-                if not self.scrollStarted:
-                    self.scrollStarted = True
-                self.timerDelay.start()
-            else:
-                self.take_screenshot()
+        height = frame.contentsSize().height()
+        logger.debug("target: %d, current: %d", target_y, current_y)
+
+        # scroll a whole screen at a time, until the bottom is reached and
+        # lazy content stopped growing the page
+        if self.use_smooth_scroll and (current_y < target_y or height != self.lastContentHeight):
+            self.lastContentHeight = height
+            y = min(current_y + self.page().viewportSize().height(), target_y)
+            frame.evaluateJavaScript("window.scrollTo(0, {:d});".format(y))
+            logger.debug("Scroll to y: %d", y)
+            self.scrollStartedAt = time.time()
+            self.timerDelay.start()
         else:
             self.take_screenshot()
 
+    def scroll_settled(self):
+        """wait until lazy images of the current screen are loaded
+        """
+        pending = self.page().mainFrame().evaluateJavaScript(PENDING_IMAGES_JS)
+        if not pending or time.time() - self.scrollStartedAt > SCROLL_STEP_TIMEOUT:
+            self.delay_action()
+        else:
+            self.timerDelay.start()
+
     def take_screenshot(self):
         frame = self.page().mainFrame()
         size = frame.contentsSize()
@@ -156,7 +172,7 @@ class Browser(QWebView):
 
         timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
         file_name = "{}_{}.png".format(args.prefix, timestamp)
-        print("page title: [{:s}] --> save as {:s}".format(self.title(), file_name))
+        logger.info("page title: [%s] --> save as %s", self.title(), file_name)
         image.save(file_name)
         sys.exit()
 
@@ -175,7 +191,12 @@ class Browser(QWebView):
 def main(args):
     """main function
     """
-    print(args)
+    if args.log_json:
+        from ghost import JSONLinesHandler
+        logging.basicConfig(level=logging.INFO, handlers=[JSONLinesHandler()])
+    else:
+        logging.basicConfig(level=logging.INFO)
+    logger.info("%s", args)
     app = QApplication(sys.argv)
     page = Page(args.agent) if args.agent else None
     browser = Browser(page)
@@ -198,6 +219,8 @@ if __name__ == "__main__":
                     help="specify PNG file prefix (timestamp follows)")
     ap.add_argument('-s', '--with-smooth-scroll', default=False, action="store_true",
                     help="whether scroll down to bottom when capture the page or not")
+    ap.add_argument('-j', '--log-json', default=False, action="store_true",
+                    help="write logs as JSON lines, from a background thread")
     ap.add_argument('url', help="specify request url")
     args = ap.parse_args()
 
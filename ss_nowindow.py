@@ -1,10 +1,23 @@
 # -*- coding: utf-8 -*-
-"""Web screen capture script with QtWebKit."""
+"""Web screen capture script with QtWebKit.
+
+Needs ghost.py next to it, for the fast capture profile and page keys it
+shares with ghost sessions.
+"""
+import argparse
+import base64
 import datetime
+import hashlib
+import json
 import logging
+import os
+import re
+import sqlite3
 import sys
 import time
 
+from contextlib import contextmanager, nullcontext
+from types import SimpleNamespace
 from urllib.parse import quote_plus, urlparse
 
 from PyQt5.QtCore import QSize, QTimer, QUrl, Qt
@@ -13,11 +26,24 @@ from PyQt5.QtNetwork import (
     QNetworkAccessManager,
     QNetworkCookie,
     QNetworkCookieJar,
+    QNetworkDiskCache,
+    QNetworkRequest,
 )
 from PyQt5.QtWebKit import QWebSettings
-from PyQt5.QtWebKitWidgets import QWebPage
+from PyQt5.QtWebKitWidgets import QWebFrame, QWebPage
 from PyQt5.QtWidgets import QApplication
 
+# fast capture profile (subresources to block, a user style sheet stopping
+# CSS animations) and page keys, shared with ghost: this script is no longer
+# standalone
+from ghost import (
+    FAST_CAPTURE_EXCLUDE,
+    NO_ANIMATION_CSS,
+    WarmedHosts,
+    is_main_document_request,
+    page_key,
+)
+
 logger = logging.getLogger(__name__)
 
 FONT_FAMILY_NAME = 'Noto Sans CJK JP'
@@ -26,12 +52,31 @@ DEFAULT_USERAGENT = ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_5)'
                      ' CDP/47.0.2526.73 Safari/537.36')
 DEFAULT_PREFIX = 'screenshot'
 
+# Poll interval (ms) while waiting for the network or a scrolled screen to
+# settle, and the longest wait (s) per screen before scrolling on anyway.
+SCROLL_SETTLE_INTERVAL = 20
+SCROLL_STEP_TIMEOUT = 1.0
+# Time (ms) given to relayout and resize handlers after a viewport change.
+VIEWPORT_SETTLE_INTERVAL = 100
+# Time (ms) a failed load waits for a following one (e.g. a script
+# redirect cancelling it) before it counts as an error.
+LOAD_FAILED_GRACE_INTERVAL = 500
+PENDING_IMAGES_JS = (
+    'Array.prototype.filter.call(document.images,'
+    ' function (img) { return !img.complete; }).length'
+)
+
+
+def generate_cookie(url, cookies, cookie_jar=None):
+    """Generate cookie via cookiejar.
 
-def generate_cookie(url, cookies):
-    """Generate cookie via cookiejar."""
+    When `cookie_jar` is given, cookies are added to it instead of a new jar
+    so that several shooters can share one login.
+    """
     logger.info("Generate Cookies: {0} {1}".format(url, cookies))
+    qcookiejar = QNetworkCookieJar() if cookie_jar is None else cookie_jar
     if not cookies:
-        return QNetworkCookieJar()
+        return qcookiejar
 
     qcookies = []
     res = urlparse(url)
@@ -43,11 +88,30 @@ def generate_cookie(url, cookies):
             qcookie.setSecure(True)
         qcookies.append(qcookie)
 
-    qcookiejar = QNetworkCookieJar()
-    qcookiejar.setCookieFromUrl(qcookies, QUrl(url))
+    qcookiejar.setCookiesFromUrl(qcookies, QUrl(url))
     return qcookiejar
 
 
+def make_cookies(cookies):
+    """Return cookies as generate_cookie() takes them, from JSON data.
+
+    `cookies` is a {name: value} dict, or a list of [name, value] pairs or
+    of {"name": ..., "value": ...} objects.
+    """
+    if isinstance(cookies, dict):
+        cookies = cookies.items()
+    pairs = [
+        (cookie['name'], cookie['value']) if isinstance(cookie, dict) else cookie
+        for cookie in cookies or []
+    ]
+    return [
+        SimpleNamespace(
+            name=str(name).encode('utf-8'), value=str(value).encode('utf-8'),
+        )
+        for name, value in pairs
+    ]
+
+
 class UserAgent(object):
     """UserAgent for WebKitshooter."""
 
@@ -64,6 +128,75 @@ class UserAgent(object):
 class WebKitShooterNetworkManager(QNetworkAccessManager):
     """NetworkAccessManager for WebKitShooter."""
 
+    def __init__(self, *args, **kwargs):
+        """Initialize."""
+        super().__init__(*args, **kwargs)
+        self.no_cache = True
+        # unless False, SSL errors are ignored and such pages load anyway
+        self.ignore_ssl_errors = True
+        self.inflight = 0
+        self.last_activity = time.time()
+        # page_key() -> [in-flight requests, last activity], so that pages
+        # sharing this manager can wait for their own requests only
+        self.pages = {}
+        # page_key() -> options overriding the manager's for that page
+        self.page_options = {}
+        self.warmed = WarmedHosts()
+        self.finished.connect(self._request_finished)
+        self.sslErrors.connect(self._ssl_errors_slot)
+
+    def _track(self, key, delta):
+        """Count in-flight requests, in total and per page."""
+        now = time.time()
+        self.inflight += delta
+        self.last_activity = now
+        if key is not None:
+            if delta < 0 and key not in self.pages:
+                # the page was forgotten while its requests were running
+                return
+            activity = self.pages.setdefault(key, [0, now])
+            activity[0] += delta
+            activity[1] = now
+
+    def _request_finished(self, reply):
+        """Count down in-flight requests."""
+        self._track(reply.property('page_key'), -1)
+
+    def forget_page(self, page):
+        """Drop the activity kept for a page that is going away."""
+        key = page_key(page)
+        self.pages.pop(key, None)
+        self.page_options.pop(key, None)
+
+    def _ssl_errors_slot(self, reply, errors):
+        """Ignore SSL errors, unless the page asked not to."""
+        options = self.page_options.get(reply.property('page_key'), {})
+        if options.get('ignore_ssl_errors', self.ignore_ssl_errors):
+            logger.debug("SSL error occured: %s", errors)
+            reply.ignoreSslErrors()
+        else:
+            logger.warning(
+                "SSL error, not loading %s: %s",
+                reply.url().toString(), [e.errorString() for e in errors],
+            )
+
+    def inflight_for(self, page):
+        """Return the number of requests running for `page`."""
+        return self.pages.get(page_key(page), (0, 0))[0]
+
+    def is_idle(self, idle_ms, max_inflight=0, page=None):
+        """Return True when no more than `max_inflight` requests are running
+        and none started or ended for `idle_ms` milliseconds, optionally
+        only counting requests of `page`."""
+        if page is None:
+            inflight, last_activity = self.inflight, self.last_activity
+        else:
+            inflight, last_activity = self.pages.get(page_key(page), (0, 0))
+        return (
+            inflight <= max_inflight and
+            (time.time() - last_activity) * 1000 >= idle_ms
+        )
+
     def set_accept_languages(self, accept_languages):
         """Handle 'Accept-Languages' value."""
         logger.info("Set Accept-Languages: {0}".format(accept_languages))
@@ -74,26 +207,119 @@ class WebKitShooterNetworkManager(QNetworkAccessManager):
         logger.info("Set Referer: {0}".format(referer))
         self.referer = referer
 
+    def set_fast_capture(self):
+        """Block media, web font, beacon and iframe requests."""
+        logger.info("Enable fast capture request blocking")
+        self.block_regex = re.compile(FAST_CAPTURE_EXCLUDE)
+
+    def set_page_options(
+        self, page, accept_languages=None, referer=None, fast_capture=False,
+        ignore_ssl_errors=None,
+    ):
+        """Handle 'Accept-Languages', 'Referer', fast capture and SSL errors
+        for the requests of one page only, when the manager is shared."""
+        options = {}
+        if ignore_ssl_errors is not None:
+            options['ignore_ssl_errors'] = ignore_ssl_errors
+        if accept_languages:
+            options['accept_languages'] = accept_languages
+        if referer:
+            options['referer'] = referer
+        if fast_capture:
+            options['block_regex'] = re.compile(FAST_CAPTURE_EXCLUDE)
+        if options:
+            self.page_options[page_key(page)] = options
+
+    def warm_up(self, urls):
+        """Resolve and pre-connect the hosts of given urls, unless warmed
+        up less than a minute ago (see ghost.WarmedHosts)."""
+        for url in urls:
+            qurl = QUrl(url)
+            secure = qurl.scheme() == 'https'
+            port = qurl.port(443 if secure else 80)
+            if not self.warmed.claim((qurl.host(), port, secure)):
+                continue
+            logger.info("Warm up: {0}".format(qurl.host()))
+            if secure:
+                self.connectToHostEncrypted(qurl.host(), port)
+            else:
+                self.connectToHost(qurl.host(), port)
+
+    def _is_blocked(self, req, block_regex):
+        """Return True when the request must not reach the network."""
+        if block_regex is None:
+            return False
+        if (
+            block_regex.search(req.url().toString()) and
+            not is_main_document_request(req)
+        ):
+            return True
+        frame = req.originatingObject()
+        return isinstance(frame, QWebFrame) and frame.parentFrame() is not None
+
     def createRequest(self, op, req, outgoing_data):  # noqa: N802
         """Create request object with RawHeader values."""
-        req.setRawHeader(
-            bytes('Cache-Control', 'utf-8'),
-            bytes('no-cache', 'utf-8'),
+        frame = req.originatingObject()
+        key = page_key(frame.page()) if isinstance(frame, QWebFrame) else None
+        self._track(key, 1)
+        options = self.page_options.get(key, {})
+        accept_languages = options.get(
+            'accept_languages', getattr(self, 'accept_languages', None),
+        )
+        referer = options.get('referer', getattr(self, 'referer', None))
+        block_regex = options.get(
+            'block_regex', getattr(self, 'block_regex', None),
         )
 
-        if hasattr(self, 'accept_languages'):
+        if self._is_blocked(req, block_regex):
+            logger.debug("Blocked: %s", req.url().toString())
+            reply = super().createRequest(
+                QNetworkAccessManager.GetOperation, QNetworkRequest(QUrl()),
+            )
+            reply.setProperty('page_key', key)
+            return reply
+
+        if self.no_cache:
+            req.setRawHeader(
+                bytes('Cache-Control', 'utf-8'),
+                bytes('no-cache', 'utf-8'),
+            )
+
+        if accept_languages is not None:
             req.setRawHeader(
                 bytes('Accept-Languages', 'utf-8'),
-                bytes(quote_plus(self.accept_languages), 'utf-8'),
+                bytes(quote_plus(accept_languages), 'utf-8'),
             )
 
-        if hasattr(self, 'referer'):
+        if referer is not None:
             req.setRawHeader(
                 bytes('Referer', 'utf-8'),
-                bytes(quote_plus(self.referer), 'utf-8'),
+                bytes(quote_plus(referer), 'utf-8'),
             )
 
-        return super().createRequest(op, req, outgoing_data)
+        reply = super().createRequest(op, req, outgoing_data)
+        reply.setProperty('page_key', key)
+        return reply
+
+
+def shared_network_manager(cache_dir=None, cache_size=100 * 1024 * 1024):
+    """Create a network manager to be shared by several WebKitShooters.
+
+    Pages then reuse the same keep-alive connections, and the same disk
+    cache when `cache_dir` is given (requests no longer force 'no-cache').
+    Headers and fast capture blocking set on it by its owner, e.g.
+    `manager.set_accept_languages('en,ja')`, apply to every page; a
+    shooter's own `accept_languages`, `referer` and `fast_capture` apply
+    to its requests only.
+    """
+    manager = WebKitShooterNetworkManager()
+    manager.no_cache = False
+    if cache_dir:
+        cache = QNetworkDiskCache(manager)
+        cache.setCacheDirectory(cache_dir)
+        cache.setMaximumCacheSize(cache_size)
+        manager.setCache(cache)
+    return manager
 
 
 class WebKitShooter(QWebPage):
@@ -107,8 +333,39 @@ class WebKitShooter(QWebPage):
         referer=None,
         scroll=False,
         prefix=DEFAULT_PREFIX,
+        cookie_jar=None,
+        idle_ms=500,
+        max_inflight=0,
+        fast_capture=False,
+        preconnect=None,
+        network_access_manager=None,
+        profiler=None,
+        viewports=None,
+        thumbnails=None,
+        above_the_fold=False,
+        image_format='png',
+        ignore_ssl_errors=True,
     ):
-        """Initialize."""
+        """Initialize.
+
+        `profiler` is an optional ghost.StageProfiler; run() starts a job
+        with stages network, layout, js, render and save.
+
+        `viewports` is an optional list of (width, height); the page is
+        then loaded once and captured at each size.
+
+        `thumbnails` is an optional list of widths; only previews of those
+        widths are saved, rendered at scale instead of full size.
+
+        `image_format` is the file extension, and so the format, of saved
+        images.
+
+        With `above_the_fold`, only the first screen is captured, as soon
+        as it is laid out and painted rather than once fully loaded.
+
+        Unless `ignore_ssl_errors`, a page whose certificate does not
+        verify fails to load, setting `error`.
+        """
         super(QWebPage, self).__init__()
 
         # attributes
@@ -119,13 +376,32 @@ class WebKitShooter(QWebPage):
         self.user_agent = user_agent
         self.accept_languages = accept_languages
         self.cookies = cookies
+        self.cookie_jar = cookie_jar
         self.referer = referer
         self.prefix = prefix
+        self.idle_ms = idle_ms
+        self.max_inflight = max_inflight
+        self.fast_capture = fast_capture
+        self.preconnect = preconnect
+        self.network_access_manager = network_access_manager
+        self.profiler = profiler
+        self.loadStartedAt = None
+        self.viewports = list(viewports or [])
+        self.thumbnails = sorted(set(thumbnails or []), reverse=True)
+        if self.thumbnails and self.thumbnails[-1] <= 0:
+            raise ValueError(
+                "thumbnail widths must be positive: %r" % self.thumbnails)
+        self.above_the_fold = above_the_fold
+        self.image_format = image_format
+        self.ignore_ssl_errors = ignore_ssl_errors
 
         # flags
         self.loadCompleted = False
         self.initialLayoutFinished = False
         self.finished = False
+        self.error = None
+        self.files = []
+        self.captureDispatched = False
         self.scroll = scroll
 
         self._initialize()
@@ -139,87 +415,183 @@ class WebKitShooter(QWebPage):
 
         self.loadProgress.connect(self.load_progress_slot)
         self.loadFinished.connect(self.load_finished_slot)
+        self.mainFrame().loadStarted.connect(self.load_started_slot)
+        self.timerLoadFailed = QTimer()
+        self.timerLoadFailed.setInterval(LOAD_FAILED_GRACE_INTERVAL)
+        self.timerLoadFailed.setSingleShot(True)
+        self.timerLoadFailed.timeout.connect(self.load_failed_slot)
         self.mainFrame().initialLayoutCompleted.connect(
             self.initial_layout_slot,
         )
+        if self.above_the_fold:
+            self.repaintRequested.connect(self.first_paint_slot)
+
+        self.timerIdle = QTimer()
+        self.timerIdle.setInterval(SCROLL_SETTLE_INTERVAL)
+        self.timerIdle.setSingleShot(True)
+        self.timerIdle.timeout.connect(self.network_idle_slot)
+        self.idleWaitStartedAt = None
 
         if self.scroll:
             self.timerScroll = QTimer()
-            self.timerScroll.setInterval(50)
+            self.timerScroll.setInterval(SCROLL_SETTLE_INTERVAL)
             self.timerScroll.setSingleShot(True)
-            self.timerScroll.timeout.connect(self.post_loaded)
+            self.timerScroll.timeout.connect(self.scroll_settled_slot)
+            self.scrollStartedAt = None
+            self.lastContentHeight = None
+
+        if self.viewports:
+            self.timerViewport = QTimer()
+            self.timerViewport.setInterval(VIEWPORT_SETTLE_INTERVAL)
+            self.timerViewport.setSingleShot(True)
+            self.timerViewport.timeout.connect(self.viewport_settled_slot)
 
         self._set_fontfamily()
         self._set_props_to_network_access_manager()
         self._remove_scroll_bars()
         self._set_private_browse()
+        if self.fast_capture:
+            self._set_fast_capture()
 
     def load_progress_slot(self, progress):
-        """Print prgress message when content loading in progress."""
-        logger.info("load progress: {0:d}%".format(progress))
+        """Log prgress message when content loading in progress."""
+        logger.debug("load progress: %d%%", progress)
+
+    def load_started_slot(self):
+        """A new load supersedes a failed one, e.g. a script redirect
+        cancelling the first navigation."""
+        self.timerLoadFailed.stop()
+
+    def load_failed_slot(self):
+        """Flag the failed load, no other load followed it."""
+        self.error = "load failed"
 
     def load_finished_slot(self, ok):
         """Dispatch capture task when content loading finished."""
         if not ok:
-            logger.info("Loaded, but not completed: {0}".format(self.url))
+            logger.info("Loaded, but not completed: %s", self.url)
+            self.timerLoadFailed.start()
             return
         else:
-            logger.info("Load completed: {0}".format(self.url))
+            logger.info("Load completed: %s", self.url)
             self.loadCompleted = True
+            self._record("network")
 
         if self.loadCompleted and self.initialLayoutFinished:
-            logger.info(
-                "Load completed: {0}, Initial layout finished: {1}".format(
-                    self.loadCompleted,
-                    self.initialLayoutFinished,
-                ),
+            logger.debug(
+                "Load completed: %s, Initial layout finished: %s",
+                self.loadCompleted,
+                self.initialLayoutFinished,
             )
             logger.info(
-                "Loaded size: W:{0} x H:{1}".format(
-                    self.mainFrame().contentsSize().width(),
-                    self.mainFrame().contentsSize().height(),
-                ),
+                "Loaded size: W:%d x H:%d",
+                self.mainFrame().contentsSize().width(),
+                self.mainFrame().contentsSize().height(),
             )
-            self.post_loaded()
+            self.wait_network_idle()
 
     def initial_layout_slot(self):
         """Dispatch capture task when initial layout setting finished."""
-        logger.debug("Layouted: {0}".format(self.url))
+        logger.debug("Layouted: %s", self.url)
         self.initialLayoutFinished = True
+        self._record("layout")
 
         if self.loadCompleted and self.initialLayoutFinished:
-            logger.debug("Capture from layout: {0}".format(self.url))
+            logger.debug("Capture from layout: %s", self.url)
             logger.debug(
-                "Loaded size: W:{0} x H:{1}".format(
-                    self.mainFrame().contentsSize().width,
-                    self.mainFrame().contentsSize().height,
-                ),
+                "Loaded size: W:%d x H:%d",
+                self.mainFrame().contentsSize().width(),
+                self.mainFrame().contentsSize().height(),
             )
+            self.wait_network_idle()
+
+    def first_paint_slot(self, rect):
+        """Capture the first screen once it is laid out and painted."""
+        if self.initialLayoutFinished and not self.captureDispatched:
+            logger.info("First paint: %s", self.url)
+            self._record("first_paint")
+            self.render_and_capture()
+
+    def wait_network_idle(self):
+        """Wait until the network is quiet, at most `wait_time` seconds."""
+        if self.idleWaitStartedAt is not None:
+            # both load and layout slots may get here
+            return
+        self.idleWaitStartedAt = time.time()
+        self.network_idle_slot()
+
+    def network_idle_slot(self):
+        """Dispatch delaying action once the network is idle."""
+        idle = self.networkAccessManager().is_idle(
+            self.idle_ms, self.max_inflight, page=self,
+        )
+        if idle or time.time() - self.idleWaitStartedAt > self.wait_time:
+            logger.info("Network idle: %s", idle)
             self.post_loaded()
+        else:
+            self.timerIdle.start()
 
     def post_loaded(self):
         """Do delaying action after content loaded."""
-        target_y = self.mainFrame().scrollBarMaximum(Qt.Vertical)
-        current_y = self.mainFrame().scrollBarValue(Qt.Vertical)
-
-        if self.scroll and target_y > current_y:
-            y = current_y + 50
-            self.mainFrame().evaluateJavaScript(
-                'window.scrollTo(0, {0:d})'.format(y),
-            )
-            logger.info("Scroll to Y:{0:,d}".format(y))
+        if self.scroll and self._scroll_to_next_screen():
+            self.scrollStartedAt = time.time()
             self.timerScroll.start()
         else:
             self.render_and_capture()
 
-    def _ssl_errors_slot(self, reply, errors):
-        """Print error messages when SSL error occured."""
-        logger.debug("SSL error occured: {0}".format(errors))
-        reply.ignoreSslErrors()
+    def _scroll_to_next_screen(self):
+        """Scroll down by one viewport.
+
+        Return False once the bottom is reached and the content height has
+        stopped growing.
+        """
+        frame = self.mainFrame()
+        height = frame.contentsSize().height()
+        current_y = frame.scrollPosition().y()
+        target_y = max(height - self.viewportSize().height(), 0)
+
+        if current_y >= target_y and height == self.lastContentHeight:
+            return False
+        self.lastContentHeight = height
+
+        y = min(current_y + self.viewportSize().height(), target_y)
+        with self._stage("js"):
+            frame.evaluateJavaScript('window.scrollTo(0, {0:d})'.format(y))
+        logger.debug("Scroll to Y:%d", y)
+        return True
+
+    def scroll_settled_slot(self):
+        """Move to the next screen once lazy content of this one is loaded."""
+        with self._stage("js"):
+            pending_images = self.mainFrame().evaluateJavaScript(PENDING_IMAGES_JS)
+        idle = (
+            self.networkAccessManager().inflight_for(self) <= 0 and
+            not pending_images
+        )
+        if idle or time.time() - self.scrollStartedAt > SCROLL_STEP_TIMEOUT:
+            self.post_loaded()
+        else:
+            self.timerScroll.start()
+
+    def _record(self, stage):
+        """Record time since load started as a profiler stage."""
+        if self.profiler is not None and self.loadStartedAt is not None:
+            self.profiler.record(stage, time.perf_counter() - self.loadStartedAt)
+
+    def _stage(self, stage):
+        """Return a context manager timing a profiler stage, if any."""
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.stage(stage)
 
     def _set_props_to_network_access_manager(self):
         """Initialize NetworkManager."""
+        if self.network_access_manager is not None:
+            self._use_shared_network_access_manager()
+            return
+
         network_access_manager = WebKitShooterNetworkManager()
+        network_access_manager.ignore_ssl_errors = self.ignore_ssl_errors
         self.setNetworkAccessManager(network_access_manager)
 
         if self.accept_languages:
@@ -228,14 +600,49 @@ class WebKitShooter(QWebPage):
         if self.referer:
             network_access_manager.set_referer(self.referer)
 
+        if self.fast_capture:
+            network_access_manager.set_fast_capture()
+
         self.userAgentForUrl = UserAgent(self.user_agent)
 
-        if self.cookies:
+        if self.cookie_jar is not None:
+            network_access_manager.setCookieJar(
+                generate_cookie(self.url, self.cookies, self.cookie_jar),
+            )
+            # The manager takes ownership of its jar; keep the shared one
+            # alive for the other shooters.
+            self.cookie_jar.setParent(None)
+        elif self.cookies:
             network_access_manager.setCookieJar(
                 generate_cookie(self.url, self.cookies),
             )
 
-        network_access_manager.sslErrors.connect(self._ssl_errors_slot)
+        # the page itself and known sub-resource hosts (CDN, APIs) are
+        # resolved and connected while WebKit sets the page up
+        network_access_manager.warm_up([self.url] + list(self.preconnect or []))
+
+    def _use_shared_network_access_manager(self):
+        """Use a NetworkManager shared with other shooters.
+
+        Its cookie jar belongs to its owner; this page's cookies are added
+        to the jar. Headers and blocking are set for this page's requests.
+        """
+        logger.info("Use shared network manager")
+        network_access_manager = self.network_access_manager
+        self.setNetworkAccessManager(network_access_manager)
+        self.userAgentForUrl = UserAgent(self.user_agent)
+        network_access_manager.set_page_options(
+            self, accept_languages=self.accept_languages,
+            referer=self.referer, fast_capture=self.fast_capture,
+            ignore_ssl_errors=self.ignore_ssl_errors,
+        )
+
+        if self.cookies:
+            generate_cookie(
+                self.url, self.cookies, network_access_manager.cookieJar(),
+            )
+
+        network_access_manager.warm_up([self.url] + list(self.preconnect or []))
 
     def _remove_scroll_bars(self):
         """Set up ScrollBar Policy."""
@@ -256,26 +663,91 @@ class WebKitShooter(QWebPage):
         self.settings().setFontFamily(
             QWebSettings.SerifFont, FONT_FAMILY_NAME,
         )
+        self.settings().setFontFamily(
+            QWebSettings.SansSerifFont, FONT_FAMILY_NAME,
+        )
 
     def _set_private_browse(self):
         """Set up Private browsing mode."""
         logger.info("Enable private browsing mode")
         self.settings().setAttribute(QWebSettings.PrivateBrowsingEnabled, True)
 
+    def _set_fast_capture(self):
+        """Set up fast capture profile: no plugins, no CSS animations.
+
+        Web fonts are blocked by the network manager, so text falls back to
+        the font family set by `_set_fontfamily`.
+        """
+        logger.info("Enable fast capture profile")
+        self.settings().setAttribute(QWebSettings.PluginsEnabled, False)
+        self.settings().setAttribute(QWebSettings.JavaEnabled, False)
+        self.settings().setUserStyleSheetUrl(QUrl(
+            'data:text/css;charset=utf-8;base64,' +
+            base64.b64encode(NO_ANIMATION_CSS.encode('utf-8')).decode('ascii'),
+        ))
+
     def run(self):
         """Dispatch screen capture task."""
         logger.info("Take a screen capture: {0}".format(self.url))
+        if self.profiler is not None:
+            self.profiler.start_job(self.url)
+        self.loadStartedAt = time.perf_counter()
         self.mainFrame().load(QUrl(self.url))
 
     def render_and_capture(self):
-        """Render content and save capture into image file."""
+        """Render content and save capture into image file(s)."""
+        if self.captureDispatched:
+            # load, layout and first paint may all get here
+            return
+        self.captureDispatched = True
+
+        if self.viewports:
+            self._next_viewport()
+            return
+
+        self._render_to_file(self.width, "{0}_{1}.{2}".format(
+            self.prefix,
+            datetime.datetime.now().strftime("%Y%m%d%H%M%S"),
+            self.image_format,
+        ))
+        self._finish()
+
+    def _next_viewport(self):
+        """Resize to the next viewport and wait for relayout."""
+        width, height = self.viewports[0]
+        logger.info("Set Viewport: W:%d x H:%d", width, height)
+        self.setPreferredContentsSize(QSize(width, height))
+        self.setViewportSize(QSize(width, height))
+        self.timerViewport.start()
+
+    def viewport_settled_slot(self):
+        """Capture the current viewport, then move to the next one."""
+        width, height = self.viewports.pop(0)
+        self._render_to_file(width, "{0}_{1:d}x{2:d}_{3}.{4}".format(
+            self.prefix, width, height,
+            datetime.datetime.now().strftime("%Y%m%d%H%M%S"),
+            self.image_format,
+        ))
+        if self.viewports:
+            self._next_viewport()
+        else:
+            self._finish()
+
+    def _render_to_file(self, width, file_name):
+        """Render the whole content (or only the current viewport when
+        above the fold) at `width` and save it as `file_name`."""
         logger.info("Render: {0}".format(self.url))
-        self.setViewportSize(
-            QSize(
-                self.width,
-                self.mainFrame().contentsSize().height(),
-            ),
-        )
+        if not self.above_the_fold:
+            self.setViewportSize(
+                QSize(
+                    width,
+                    self.mainFrame().contentsSize().height(),
+                ),
+            )
+        if self.thumbnails:
+            self._render_thumbnails(file_name)
+            return
+
         image = QImage(self.viewportSize(), QImage.Format_ARGB32)
 
         painter = QPainter(image)
@@ -284,47 +756,422 @@ class WebKitShooter(QWebPage):
         painter.setRenderHint(QPainter.TextAntialiasing)
         painter.setRenderHint(QPainter.HighQualityAntialiasing)
 
-        self.mainFrame().render(painter)
+        with self._stage("render"):
+            self.mainFrame().render(painter)
         painter.end()
 
-        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-        file_name = "{0}_{1}.png".format(self.prefix, timestamp)
         logger.info(
             "Page title: [{0:s}] --> save as {1:s}".format(
                 self.mainFrame().title(),
                 file_name,
             ),
         )
-        image.save(file_name)
+        with self._stage("save"):
+            image.save(file_name)
+        self.files.append(file_name)
+
+    def _render_thumbnails(self, file_name):
+        """Render the largest thumbnail through a scaled painter, reduce it
+        to the other widths and save them as `<name>_w<width>.<format>`."""
+        size = self.viewportSize()
+        scale = float(self.thumbnails[0]) / max(size.width(), 1)
+        image = QImage(
+            self.thumbnails[0], max(1, int(size.height() * scale)),
+            QImage.Format_ARGB32,
+        )
+
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setRenderHint(QPainter.TextAntialiasing)
+        painter.scale(scale, scale)
+
+        with self._stage("render"):
+            self.mainFrame().render(painter)
+        painter.end()
+
+        stem = os.path.splitext(file_name)[0]
+        for width in self.thumbnails:
+            thumbnail = image if width == self.thumbnails[0] else \
+                image.scaledToWidth(width, Qt.SmoothTransformation)
+            thumbnail_name = "{0}_w{1:d}.{2}".format(
+                stem, width, self.image_format,
+            )
+            logger.info("Save thumbnail: %s", thumbnail_name)
+            with self._stage("save"):
+                thumbnail.save(thumbnail_name)
+            self.files.append(thumbnail_name)
+
+    def _finish(self):
+        """Close the profiler job and flag the capture as done."""
+        if self.profiler is not None:
+            report = self.profiler.end_job()
+            logger.info("Profile: %s", report['stages'])
         self.finished = True
 
+    def release(self):
+        """Stop loading and schedule the page for deletion.
+
+        Its request activity is dropped from the network manager, which may
+        be shared with shooters still running.
+        """
+        self.timerLoadFailed.stop()
+        self.triggerAction(QWebPage.Stop)
+        manager = self.networkAccessManager()
+        if isinstance(manager, WebKitShooterNetworkManager):
+            manager.forget_page(self)
+        self.deleteLater()
+
+
+def shoot(
+    url, width, height, prefix=None, scroll=False, fast_capture=False,
+    profiler=None, viewports=None, thumbnails=None, above_the_fold=False,
+    cache=None,
+):
+    """Take screenshot.
+
+    `cache` is an optional ghost.CaptureCache; a single-image capture found
+    there is copied to its file name without loading the page.
+    """
+    cache_key = None
+    if cache is not None and not viewports and len(thumbnails or []) <= 1:
+        cache_key = cache.key(
+            url, (1366, 600), DEFAULT_USERAGENT, [], 'png',
+            scroll=scroll, fast_capture=fast_capture, thumbnails=thumbnails,
+            above_the_fold=above_the_fold,
+        )
+        file_name = "{0}_{1}".format(
+            prefix, datetime.datetime.now().strftime("%Y%m%d%H%M%S"),
+        )
+        if thumbnails:
+            file_name += "_w{0:d}".format(thumbnails[0])
+        file_name += ".png"
+        if cache.get(cache_key, file_name):
+            logger.info("From cache: %s --> %s", url, file_name)
+            return
 
-def shoot(url, width, height, prefix=None, scroll=False):
-    """Take screenshot."""
     qapp = QApplication(sys.argv)
 
     shooter = WebKitShooter(
         url, width=1366, height=600, prefix=prefix, scroll=scroll,
+        fast_capture=fast_capture, profiler=profiler, viewports=viewports,
+        thumbnails=thumbnails, above_the_fold=above_the_fold,
     )
     shooter.run()
 
-    while not shooter.finished:
+    while not shooter.finished and shooter.error is None:
         qapp.processEvents()
         time.sleep(0.01)
+    if cache_key is not None and shooter.finished:
+        cache.put(cache_key, shooter.files[0])
     shooter = None
 
 
+class JobQueue(object):
+    """Persistent capture job queue in a SQLite database.
+
+    Jobs are WebKitShooter arguments (a url and keyword options). A job
+    put while an identical one is queued or running is not added twice.
+    Failed jobs may be retried later with exponential backoff.
+    """
+
+    _schema = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL,
+            url TEXT NOT NULL,
+            options TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            not_before REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            result TEXT,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, not_before);
+        CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status);
+    """
+
+    def __init__(self, path, timeout=5.0):
+        """Open (and create) the queue database at `path`."""
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(self._schema)
+
+    @staticmethod
+    def job_key(url, options):
+        """Return the key identifying identical jobs."""
+        return hashlib.sha1(
+            json.dumps([url, options], sort_keys=True).encode('utf-8'),
+        ).hexdigest()
+
+    def put(self, url, **options):
+        """Queue a capture of `url`; return the job id.
+
+        The id of an identical queued or running job is returned instead
+        of adding a new one.
+        """
+        key = self.job_key(url, options)
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT id FROM jobs WHERE key = ?"
+                " AND status IN ('queued', 'running')",
+                (key,),
+            ).fetchone()
+            if row is not None:
+                logger.info("Job already queued: %s (%d)", url, row[0])
+                return row[0]
+            cursor = db.execute(
+                "INSERT INTO jobs (key, url, options, status, not_before,"
+                " updated_at) VALUES (?, ?, ?, 'queued', ?, ?)",
+                (key, url, json.dumps(options), now, now),
+            )
+            return cursor.lastrowid
+
+    def claim(self, limit):
+        """Mark up to `limit` due jobs as running and return them as
+        (id, url, options, attempts) tuples."""
+        now = time.time()
+        with self._transaction() as db:
+            rows = db.execute(
+                "SELECT id, url, options, attempts FROM jobs"
+                " WHERE status = 'queued' AND not_before <= ?"
+                " ORDER BY not_before, id LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            db.executemany(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1,"
+                " updated_at = ? WHERE id = ?",
+                [(now, row[0]) for row in rows],
+            )
+        return [
+            (job_id, url, json.loads(options), attempts + 1)
+            for job_id, url, options, attempts in rows
+        ]
+
+    def complete(self, job_id, result):
+        """Record the result of a successful job."""
+        self._db.execute(
+            "UPDATE jobs SET status = 'done', result = ?, error = NULL,"
+            " updated_at = ? WHERE id = ?",
+            (json.dumps(result), time.time(), job_id),
+        )
+
+    def fail(self, job_id, error, retry_in=None):
+        """Record a failed job, queued again in `retry_in` seconds unless
+        that is None."""
+        now = time.time()
+        if retry_in is None:
+            self._db.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, updated_at = ?"
+                " WHERE id = ?",
+                (error, now, job_id),
+            )
+        else:
+            self._db.execute(
+                "UPDATE jobs SET status = 'queued', error = ?, not_before = ?,"
+                " updated_at = ? WHERE id = ?",
+                (error, now + retry_in, now, job_id),
+            )
+
+    def requeue_running(self):
+        """Queue again jobs left running by a worker that died."""
+        cursor = self._db.execute(
+            "UPDATE jobs SET status = 'queued', updated_at = ?"
+            " WHERE status = 'running'",
+            (time.time(),),
+        )
+        return cursor.rowcount
+
+    def get(self, job_id):
+        """Return a job record as a dict, or None."""
+        cursor = self._db.execute(
+            "SELECT id, url, options, status, attempts, result, error"
+            " FROM jobs WHERE id = ?",
+            (job_id,),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        job = dict(zip([column[0] for column in cursor.description], row))
+        job['options'] = json.loads(job['options'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def pending(self):
+        """Return the number of queued and running jobs."""
+        return self._db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')",
+        ).fetchone()[0]
+
+    @contextmanager
+    def _transaction(self):
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self._db
+        except Exception:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def close(self):
+        """Close the database."""
+        self._db.close()
+
+
+def run_worker(
+    queue_path, concurrency=4, max_attempts=3, backoff=5.0, job_timeout=60.0,
+    poll_interval=0.5, exit_when_empty=False,
+):
+    """Capture jobs from a JobQueue, at most `concurrency` at a time.
+
+    Shooters share one network manager, except jobs with cookies (as
+    make_cookies() reads them): those get a private one, so that cookies
+    never reach other jobs. A job that fails to load, SSL errors included
+    for jobs with `ignore_ssl_errors` off, or takes more than `job_timeout`
+    seconds is retried after `backoff` seconds, doubled on each attempt,
+    until `max_attempts` is reached.
+    """
+    qapp = QApplication.instance() or QApplication(sys.argv)
+    queue = JobQueue(queue_path)
+    requeued = queue.requeue_running()
+    if requeued:
+        logger.info("Requeued %d interrupted job(s)", requeued)
+    manager = shared_network_manager()
+
+    # job id -> (shooter, attempts, started at)
+    active = {}
+    last_poll = 0
+    try:
+        while True:
+            now = time.time()
+            if len(active) < concurrency and now - last_poll >= poll_interval:
+                last_poll = now
+                for job_id, url, options, attempts in queue.claim(
+                    concurrency - len(active),
+                ):
+                    logger.info("Start job %d: %s (attempt %d)", job_id, url, attempts)
+                    kwargs = dict(options)
+                    if kwargs.get('cookies'):
+                        kwargs['cookies'] = make_cookies(kwargs['cookies'])
+                    else:
+                        kwargs['network_access_manager'] = manager
+                    try:
+                        shooter = WebKitShooter(url, **kwargs)
+                        shooter.run()
+                    except Exception as e:
+                        # bad options, retrying will not help
+                        queue.fail(job_id, repr(e))
+                        continue
+                    active[job_id] = (shooter, attempts, now)
+
+            for job_id, (shooter, attempts, started_at) in list(active.items()):
+                if shooter.finished:
+                    queue.complete(job_id, {
+                        'files': shooter.files,
+                        'seconds': time.time() - started_at,
+                    })
+                    logger.info("Job %d done: %s", job_id, shooter.files)
+                elif shooter.error is not None or time.time() - started_at > job_timeout:
+                    error = shooter.error or 'timeout'
+                    retry_in = None
+                    if attempts < max_attempts:
+                        retry_in = backoff * 2 ** (attempts - 1)
+                    queue.fail(job_id, error, retry_in)
+                    logger.warning(
+                        "Job %d failed: %s (retry in %s)", job_id, error, retry_in,
+                    )
+                else:
+                    continue
+                del active[job_id]
+                shooter.release()
+
+            if exit_when_empty and not active and not queue.pending():
+                break
+            qapp.processEvents()
+            time.sleep(0.01)
+    finally:
+        queue.close()
+
+
+def viewport_size(value):
+    """Parse a WIDTHxHEIGHT command line value into a (width, height)."""
+    try:
+        width, height = (int(n) for n in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "expected WIDTHxHEIGHT, e.g. 1280x800: %r" % value)
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError(
+            "viewport size must be positive: %r" % value)
+    return width, height
+
+
+def positive_int(value):
+    """Parse a command line width into a positive int."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected an integer: %r" % value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError("must be positive: %r" % value)
+    return number
+
+
 def main(args):
-    logging.basicConfig(level=logging.INFO)
-    logger.info("Args: {0}".format(args))
-    shoot(
-        args.url, args.width, args.height,
-        prefix=args.prefix, scroll=args.scroll,
-    )
+    handler = None
+    if args.log_json:
+        from ghost import JSONLinesHandler
+        handler = JSONLinesHandler()
+        logging.basicConfig(level=logging.INFO, handlers=[handler])
+    else:
+        logging.basicConfig(level=logging.INFO)
+    logger.info("Args: %s", args)
+    profiler = None
+    if args.profile:
+        from ghost import StageProfiler
+        profiler = StageProfiler(
+            cprofile=True, tracemalloc=10, output=args.profile,
+        )
+    try:
+        if args.worker:
+            run_worker(
+                args.worker, concurrency=args.concurrency,
+                max_attempts=args.max_attempts,
+            )
+        elif args.enqueue:
+            queue = JobQueue(args.enqueue)
+            job_id = queue.put(
+                args.url, width=int(args.width), height=int(args.height),
+                user_agent=args.user_agent,
+                accept_languages=','.join(args.languages),
+                prefix=args.prefix, scroll=args.scroll,
+                fast_capture=args.fast, viewports=args.viewports,
+                thumbnails=args.thumbnails, above_the_fold=args.above_the_fold,
+                ignore_ssl_errors=not args.strict_ssl,
+            )
+            queue.close()
+            logger.info("Queued job %d", job_id)
+        else:
+            cache = None
+            if args.cache:
+                from ghost import CaptureCache
+                cache = CaptureCache(args.cache)
+            shoot(
+                args.url, args.width, args.height,
+                prefix=args.prefix, scroll=args.scroll,
+                fast_capture=args.fast, profiler=profiler,
+                viewports=args.viewports, thumbnails=args.thumbnails,
+                above_the_fold=args.above_the_fold, cache=cache,
+            )
+    finally:
+        if handler is not None:
+            handler.close()
 
 
 if __name__ == '__main__':
-    import argparse
     ap = argparse.ArgumentParser()
     ap.add_argument(
         '-a', '--user_agent', default=DEFAULT_USERAGENT,
@@ -344,9 +1191,53 @@ if __name__ == '__main__':
     ap.add_argument(
         '-s', '--scroll', default=False, action="store_true",
         help="Whether scroll down to botton when capture a page or not", )
-    ap.add_argument('url', help="Specify request url")
+    ap.add_argument(
+        '-f', '--fast', default=False, action="store_true",
+        help="Skip media, web fonts, iframes and beacons (text captures)", )
+    ap.add_argument(
+        '-j', '--log-json', default=False, action="store_true",
+        help="Write logs as JSON lines, from a background thread", )
+    ap.add_argument(
+        '-v', '--viewport', dest='viewports', action="append",
+        type=viewport_size, metavar='WIDTHxHEIGHT',
+        help="Capture at this viewport size instead of the default one; "
+             "the page is loaded once for all sizes (repeatable)", )
+    ap.add_argument(
+        '-t', '--thumbnail', dest='thumbnails', action="append",
+        type=positive_int,
+        metavar='WIDTH',
+        help="Only save a preview of this width, rendered at scale "
+             "(repeatable)", )
+    ap.add_argument(
+        '-F', '--above-the-fold', default=False, action="store_true",
+        help="Capture only the first screen, on first paint", )
+    ap.add_argument(
+        '--profile', default=None, metavar='PATH',
+        help="Append a per-stage, cProfile and tracemalloc report to PATH", )
+    ap.add_argument(
+        '--cache', default=None, metavar='DIR',
+        help="Serve repeated captures from the image cache in DIR", )
+    ap.add_argument(
+        '--enqueue', default=None, metavar='QUEUE',
+        help="Add the capture to the job queue database QUEUE", )
+    ap.add_argument(
+        '--strict-ssl', default=False, action="store_true",
+        help="Fail (and retry) queued captures on SSL errors", )
+    ap.add_argument(
+        '--worker', default=None, metavar='QUEUE',
+        help="Run captures from the job queue database QUEUE", )
+    ap.add_argument(
+        '--concurrency', default=4, type=int,
+        help="Captures a worker runs at once", )
+    ap.add_argument(
+        '--max-attempts', default=3, type=int,
+        help="Attempts per job before a worker gives up", )
+    ap.add_argument('url', nargs='?', help="Specify request url")
     args = ap.parse_args()
 
+    if args.url is None and not args.worker:
+        ap.error("url is required unless --worker is given")
+
     if not args.languages:
         args.languages = ['ja']
     main(args)
@@ -0,0 +1,109 @@
+import os
+import shutil
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('PyQt5.QtWebKitWidgets')
+
+from capture_server import CaptureService, QueueFull  # noqa: E402
+
+
+@pytest.fixture
+def service():
+    service = CaptureService(job_timeout=30, max_pending=2)
+    yield service
+    shutil.rmtree(service._workdir, ignore_errors=True)
+
+
+def test_normalize_defaults(service):
+    assert service.normalize({'url': 'http://example.com/', 'format': 'JPEG'}) == {
+        'url': 'http://example.com/',
+        'width': 1024,
+        'height': 768,
+        'format': 'jpg',
+        'cookies': {},
+        'wait': 'load',
+    }
+
+
+@pytest.mark.parametrize('wait', ['load', 'first_paint', 0, 1500])
+def test_normalize_valid_waits(service, wait):
+    options = service.normalize({'url': 'http://example.com/', 'wait': wait})
+    assert options['wait'] == wait
+
+
+@pytest.mark.parametrize('request_', [
+    {},
+    {'url': ''},
+    {'url': 'http://example.com/', 'format': 'gif'},
+    {'url': 'http://example.com/', 'wait': True},
+    {'url': 'http://example.com/', 'wait': False},
+    {'url': 'http://example.com/', 'wait': -1},
+    {'url': 'http://example.com/', 'wait': 1.5},
+    {'url': 'http://example.com/', 'wait': 'idle'},
+    {'url': 'http://example.com/', 'wait': 30000},
+    {'url': 'http://example.com/', 'width': 0},
+    {'url': 'http://example.com/', 'height': -768},
+    {'url': 'http://example.com/', 'width': 'wide'},
+])
+def test_normalize_rejects(service, request_):
+    with pytest.raises(ValueError):
+        service.normalize(request_)
+
+
+def test_identical_requests_are_coalesced(service):
+    options = service.normalize({'url': 'http://example.com/'})
+    job = service.submit(options)
+    assert service.submit(dict(options)) is job
+    assert service.get(job.id) is job
+
+
+def test_full_queue(service):
+    for i in range(2):
+        service.submit(service.normalize({'url': 'http://example.com/%d' % i}))
+    with pytest.raises(QueueFull):
+        service.submit(service.normalize({'url': 'http://example.com/full'}))
+
+
+def _run(service, url, image):
+    """Finish a job as the Qt loop would, with a stand-in shooter."""
+    job = service.submit(service.normalize({'url': url}))
+    service._pending.remove(job)
+    path = os.path.join(service._workdir, job.id)
+    with open(path, 'wb') as f:
+        f.write(image)
+    shooter = SimpleNamespace(
+        finished=True, error=None, files=[path], release=lambda: None)
+    service._finish(job, shooter)
+    return job
+
+
+def test_finished_job_is_served_from_cache(service):
+    job = _run(service, 'http://example.com/', b'image')
+
+    assert (job.status, job.image) == ('done', b'image')
+    assert service.submit(job.options) is job
+
+
+def test_expire_keeps_images_under_max_bytes(service):
+    service.max_image_bytes = 10
+    old = _run(service, 'http://example.com/old', b'123456')
+    new = _run(service, 'http://example.com/new', b'123456')
+
+    service._expire()
+
+    assert service.get(old.id) is None and old.image is None
+    assert service.get(new.id) is new and new.image == b'123456'
+    assert service._image_bytes == 6
+
+
+def test_expire_keeps_max_jobs(service):
+    service.max_jobs = 1
+    old = _run(service, 'http://example.com/old', b'1')
+    new = _run(service, 'http://example.com/new', b'2')
+
+    service._expire()
+
+    assert service.get(old.id) is None
+    assert service.get(new.id) is new
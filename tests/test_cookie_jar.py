@@ -0,0 +1,64 @@
+import pytest
+
+pytest.importorskip('PyQt5.QtWebKitWidgets')
+
+from PyQt5.QtCore import QUrl  # noqa: E402
+from PyQt5.QtNetwork import QNetworkCookie  # noqa: E402
+
+from ghost import SQLiteCookieJar  # noqa: E402
+
+
+URL = QUrl('http://www.example.com/')
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'cookies.db')
+
+
+def _names(cookies):
+    return sorted(bytes(cookie.name()).decode() for cookie in cookies)
+
+
+def test_domains_for_host():
+    assert SQLiteCookieJar._domains_for_host('WWW.Example.com') == [
+        'www.example.com', '.www.example.com', '.example.com',
+    ]
+
+
+def test_cookies_survive_a_new_jar(path):
+    jar = SQLiteCookieJar(path)
+    jar.setCookiesFromUrl([QNetworkCookie(b'session', b'1')], URL)
+    jar.close()
+
+    jar = SQLiteCookieJar(path)
+    assert _names(jar.cookiesForUrl(URL)) == ['session']
+    # reading them back does not delete their rows
+    assert _names(jar.cookiesForUrl(URL)) == ['session']
+    assert _names(jar.allCookies()) == ['session']
+    jar.close()
+
+
+def test_rows_deleted_elsewhere_are_dropped(path):
+    first, second = SQLiteCookieJar(path), SQLiteCookieJar(path)
+    first.setCookiesFromUrl(
+        [QNetworkCookie(b'a', b'1'), QNetworkCookie(b'b', b'2')], URL)
+    assert _names(second.cookiesForUrl(URL)) == ['a', 'b']
+
+    first.deleteCookie(first.cookiesForUrl(URL)[0])
+
+    assert len(second.cookiesForUrl(URL)) == 1
+    first.close()
+    second.close()
+
+
+def test_set_all_cookies_replaces_the_store(path):
+    jar = SQLiteCookieJar(path)
+    jar.setCookiesFromUrl([QNetworkCookie(b'old', b'1')], URL)
+    cookie = QNetworkCookie(b'new', b'2')
+    cookie.setDomain('www.example.com')
+    cookie.setPath('/')
+    jar.setAllCookies([cookie])
+
+    assert _names(jar.allCookies()) == ['new']
+    jar.close()
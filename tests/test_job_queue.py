@@ -0,0 +1,85 @@
+import pytest
+
+pytest.importorskip('PyQt5.QtWebKitWidgets')
+
+from ss_nowindow import JobQueue, make_cookies  # noqa: E402
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.db'))
+    yield queue
+    queue.close()
+
+
+def test_identical_jobs_are_queued_once(queue):
+    job_id = queue.put('http://example.com/', width=800)
+    assert queue.put('http://example.com/', width=800) == job_id
+    assert queue.put('http://example.com/', width=1024) != job_id
+    assert queue.pending() == 2
+
+
+def test_claim_marks_jobs_running(queue):
+    first = queue.put('http://example.com/1')
+    queue.put('http://example.com/2')
+
+    claimed = queue.claim(1)
+
+    assert claimed == [(first, 'http://example.com/1', {}, 1)]
+    assert queue.get(first)['status'] == 'running'
+    assert len(queue.claim(10)) == 1
+    assert queue.claim(10) == []
+
+
+def test_complete(queue):
+    job_id = queue.put('http://example.com/')
+    queue.claim(1)
+    queue.complete(job_id, {'files': ['shot.png']})
+
+    job = queue.get(job_id)
+    assert job['status'] == 'done'
+    assert job['result'] == {'files': ['shot.png']}
+    assert queue.pending() == 0
+
+
+def test_failed_job_is_retried_after_backoff(queue):
+    job_id = queue.put('http://example.com/')
+    queue.claim(1)
+    queue.fail(job_id, 'timeout', retry_in=60)
+
+    job = queue.get(job_id)
+    assert (job['status'], job['error'], job['attempts']) == ('queued', 'timeout', 1)
+    # not due yet
+    assert queue.claim(1) == []
+
+
+def test_failed_job_without_retry(queue):
+    job_id = queue.put('http://example.com/')
+    queue.claim(1)
+    queue.fail(job_id, 'load failed')
+
+    assert queue.get(job_id)['status'] == 'failed'
+    assert queue.pending() == 0
+
+
+def test_requeue_running(queue):
+    job_id = queue.put('http://example.com/')
+    queue.claim(1)
+
+    assert queue.requeue_running() == 1
+    assert queue.get(job_id)['status'] == 'queued'
+
+
+def test_get_unknown(queue):
+    assert queue.get(42) is None
+
+
+@pytest.mark.parametrize('cookies', [
+    {'session': 'abc', 'lang': 'ja'},
+    [['session', 'abc'], ['lang', 'ja']],
+    [{'name': 'session', 'value': 'abc'}, {'name': 'lang', 'value': 'ja'}],
+])
+def test_make_cookies(cookies):
+    assert sorted((c.name, c.value) for c in make_cookies(cookies)) == [
+        (b'lang', b'ja'), (b'session', b'abc'),
+    ]
@@ -0,0 +1,79 @@
+import io
+import json
+import logging
+
+import pytest
+
+pytest.importorskip('PyQt5.QtWebKitWidgets')
+
+from ghost import JSONLinesHandler  # noqa: E402
+
+
+@pytest.fixture
+def log():
+    stream = io.StringIO()
+    handler = JSONLinesHandler(stream=stream, flush_interval=0.01)
+    logger = logging.getLogger('ghost.tests.json')
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+    def lines():
+        handler.close()
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    yield logger, lines
+    logger.removeHandler(handler)
+
+
+def test_records_are_json_lines(log):
+    logger, lines = log
+    logger.info('Opening %s', 'http://example.com/')
+    logger.warning('Slow', extra={'session': 'abc', 'seconds': 2.5})
+
+    first, second = lines()
+
+    assert first['level'] == 'INFO'
+    assert first['logger'] == 'ghost.tests.json'
+    assert first['message'] == 'Opening http://example.com/'
+    assert 'args' not in first
+    assert (second['session'], second['seconds']) == ('abc', 2.5)
+
+
+def test_exceptions_are_formatted(log):
+    logger, lines = log
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        logger.exception('Failed')
+
+    record, = lines()
+    assert 'ValueError: boom' in record['exc_info']
+
+
+def test_batches_larger_than_batch_size(log):
+    logger, lines = log
+    for i in range(250):
+        logger.debug('line %d', i)
+    assert [r['message'] for r in lines()] == ['line %d' % i for i in range(250)]
+
+
+def test_unserializable_extra_is_stringified(log):
+    logger, lines = log
+    logger.info('Object', extra={'obj': object()})
+    record, = lines()
+    assert record['obj'].startswith('<object object')
+
+
+def test_other_handlers_see_the_arguments(log):
+    logger, lines = log
+    stream = io.StringIO()
+    other = logging.StreamHandler(stream)
+    logger.addHandler(other)
+    try:
+        logger.info('Opening %s', 'http://example.com/')
+    finally:
+        logger.removeHandler(other)
+
+    assert stream.getvalue() == 'Opening http://example.com/\n'
+    assert lines()[0]['message'] == 'Opening http://example.com/'
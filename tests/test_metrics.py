@@ -0,0 +1,45 @@
+import pytest
+
+pytest.importorskip('PyQt5.QtWebKitWidgets')
+
+from ghost import Metrics  # noqa: E402
+
+
+def test_render_counters_and_gauges():
+    metrics = Metrics()
+    metrics.describe('ghost_pages_opened_total', 'Pages opened.')
+    metrics.inc('ghost_pages_opened_total')
+    metrics.inc('ghost_pages_opened_total', 2)
+    metrics.set('ghost_sessions', lambda: 4)
+
+    assert metrics.render() == (
+        '# HELP ghost_pages_opened_total Pages opened.\n'
+        '# TYPE ghost_pages_opened_total counter\n'
+        'ghost_pages_opened_total 3\n'
+        '# TYPE ghost_sessions gauge\n'
+        'ghost_sessions 4\n'
+    )
+
+
+def test_render_histogram():
+    metrics = Metrics(buckets=[1, 0.5])
+    for value in (0.2, 0.7, 3):
+        metrics.observe('ghost_page_load_seconds', value)
+
+    lines = metrics.render().splitlines()
+
+    assert lines == [
+        '# TYPE ghost_page_load_seconds histogram',
+        'ghost_page_load_seconds_bucket{le="0.5"} 1',
+        'ghost_page_load_seconds_bucket{le="1"} 2',
+        'ghost_page_load_seconds_bucket{le="+Inf"} 3',
+        'ghost_page_load_seconds_sum 3.9',
+        'ghost_page_load_seconds_count 3',
+    ]
+
+
+def test_timer_observes_once():
+    metrics = Metrics()
+    with metrics.timer('ghost_capture_seconds'):
+        pass
+    assert 'ghost_capture_seconds_count 1' in metrics.render()
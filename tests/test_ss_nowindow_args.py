@@ -0,0 +1,40 @@
+import argparse
+
+import pytest
+
+pytest.importorskip('PyQt5.QtWebKitWidgets')
+
+from ss_nowindow import positive_int, viewport_size  # noqa: E402
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('1280x800', (1280, 800)),
+    ('375X667', (375, 667)),
+])
+def test_viewport_size(value, expected):
+    assert viewport_size(value) == expected
+
+
+@pytest.mark.parametrize('value', ['1280', '1280x', 'x800', '1280x800x2', 'wide', '0x800', '1280x-1'])
+def test_viewport_size_rejects(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        viewport_size(value)
+
+
+def test_viewport_size_as_argparse_type():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', dest='viewports', action='append', type=viewport_size)
+    assert parser.parse_args(['-v', '320x480', '-v', '1024x768']).viewports == [
+        (320, 480), (1024, 768),
+    ]
+
+
+@pytest.mark.parametrize('value, expected', [('1', 1), ('320', 320)])
+def test_positive_int(value, expected):
+    assert positive_int(value) == expected
+
+
+@pytest.mark.parametrize('value', ['0', '-5', '1.5', 'wide', ''])
+def test_positive_int_rejects(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        positive_int(value)
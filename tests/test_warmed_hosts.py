@@ -0,0 +1,31 @@
+import time
+
+import pytest
+
+pytest.importorskip('PyQt5.QtWebKitWidgets')
+
+from ghost import WarmedHosts  # noqa: E402
+
+
+def test_host_is_warmed_once_per_ttl():
+    hosts = WarmedHosts(ttl=60)
+    assert hosts.claim(('example.com', 443, True))
+    assert not hosts.claim(('example.com', 443, True))
+    assert hosts.claim(('example.com', 80, False))
+
+
+def test_warm_again_after_ttl():
+    hosts = WarmedHosts(ttl=60)
+    hosts.claim('example.com')
+    hosts._hosts['example.com'] = time.time() - 61
+    assert hosts.claim('example.com')
+    assert hosts.claim('example.com', ttl=0)
+
+
+def test_least_recently_warmed_are_forgotten():
+    hosts = WarmedHosts(max_hosts=2)
+    for host in ('a', 'b', 'c'):
+        hosts.claim(host)
+    assert len(hosts) == 2
+    assert hosts.claim('a')
+    assert not hosts.claim('c')